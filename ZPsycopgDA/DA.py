@@ -18,11 +18,17 @@
 
 import time
 import re
+import threading
+from collections import OrderedDict
 
 import Acquisition
 import Shared.DC.ZRDB.Connection
 
-from db import DB
+from db import DB, CACHE_SIZE
+from pool import POOL_MINCONN, POOL_MAXIDLE, POOL_MAXCONN, POOL_TIMEOUT
+from pool import POOL_VALIDATE, POOL_PING_AFTER
+from pool import POOL_BREAKER_THRESHOLD, POOL_BREAKER_COOLDOWN
+from pool import getstats
 from Globals import HTMLFile
 from ExtensionClass import Base
 from DateTime import DateTime
@@ -35,6 +41,11 @@ except ImportError:
     # hosed.
     from ImageFile import ImageFile
 
+try:
+    from App.class_init import InitializeClass
+except ImportError:
+    from Globals import InitializeClass
+
 # import psycopg and functions/singletons needed for date/time conversions
 
 import psycopg2
@@ -53,10 +64,44 @@ manage_addZPsycopgConnectionForm = HTMLFile('dtml/add', globals())
 
 def manage_addZPsycopgConnection(self, id, title, connection_string,
                                  zdatetime=None, tilevel=DEFAULT_TILEVEL,
-                                 encoding='', check=None, REQUEST=None):
+                                 encoding='', check=None,
+                                 pool_minconn=POOL_MINCONN,
+                                 pool_maxidle=POOL_MAXIDLE,
+                                 pool_maxconn=POOL_MAXCONN,
+                                 pool_timeout=POOL_TIMEOUT,
+                                 slow_query_time=0, use_prepared=None,
+                                 cache_ttl=0, cache_size=CACHE_SIZE,
+                                 replica_dsns=(), replica_reads='readonly',
+                                 pool_hosts=(),
+                                 pool_idle_timeout=0, pool_max_age=0,
+                                 pool_min_ready=0, pool_validate=POOL_VALIDATE,
+                                 pool_ping_after=POOL_PING_AFTER,
+                                 pool_breaker_threshold=POOL_BREAKER_THRESHOLD,
+                                 pool_breaker_cooldown=POOL_BREAKER_COOLDOWN,
+                                 REQUEST=None):
     """Add a DB connection to a folder."""
     self._setObject(id, Connection(id, title, connection_string,
-                                   zdatetime, check, tilevel, encoding))
+                                   zdatetime, check, tilevel, encoding,
+                                   pool_minconn=pool_minconn,
+                                   pool_maxidle=pool_maxidle,
+                                   pool_maxconn=pool_maxconn,
+                                   pool_timeout=pool_timeout,
+                                   slow_query_time=slow_query_time,
+                                   use_prepared=use_prepared,
+                                   cache_ttl=cache_ttl,
+                                   cache_size=cache_size,
+                                   replica_dsns=replica_dsns,
+                                   replica_reads=replica_reads,
+                                   pool_hosts=pool_hosts,
+                                   pool_idle_timeout=pool_idle_timeout,
+                                   pool_max_age=pool_max_age,
+                                   pool_min_ready=pool_min_ready,
+                                   pool_validate=pool_validate,
+                                   pool_ping_after=pool_ping_after,
+                                   pool_breaker_threshold=(
+                                       pool_breaker_threshold),
+                                   pool_breaker_cooldown=(
+                                       pool_breaker_cooldown)))
     if REQUEST is not None:
         return self.manage_main(self, REQUEST)
 
@@ -72,13 +117,76 @@ class Connection(Shared.DC.ZRDB.Connection.Connection):
     meta_type = title = 'Z Psycopg 2 Database Connection'
     icon = 'misc_/conn'
 
+    # connection pool settings, see pool.getpool()
+    pool_minconn = POOL_MINCONN
+    pool_maxidle = POOL_MAXIDLE
+    pool_maxconn = POOL_MAXCONN
+    pool_timeout = POOL_TIMEOUT
+
+    # seconds after which the idle or old connections are closed and idle
+    # connections kept ready by the pool maintainer (0: disabled)
+    pool_idle_timeout = 0
+    pool_max_age = 0
+    pool_min_ready = 0
+
+    # check of the idle connections handed out: 'never', 'status' or 'ping'
+    # (query the server if unused for more than pool_ping_after seconds)
+    pool_validate = POOL_VALIDATE
+    pool_ping_after = POOL_PING_AFTER
+
+    # consecutive connection failures after which the pool stops connecting
+    # for pool_breaker_cooldown seconds (0: never)
+    pool_breaker_threshold = POOL_BREAKER_THRESHOLD
+    pool_breaker_cooldown = POOL_BREAKER_COOLDOWN
+
+    # queries taking longer than this number of seconds are logged (0: never)
+    slow_query_time = 0
+
+    # execute parametrized queries as server-side prepared statements
+    use_prepared = None
+
+    # seconds the query results are cached (0: disabled) and cache size
+    cache_ttl = 0
+    cache_size = CACHE_SIZE
+
+    # connection strings of the read-only replicas of the database
+    replica_dsns = ()
+
+    # transactions reading from the replicas: 'readonly' (only the ones
+    # declared with readOnlyTransaction()) or 'before_write' (any, until
+    # they write something: the reads are not isolated from the writes)
+    replica_reads = 'readonly'
+
+    # alternative 'host[:port]' of the database, tried fastest first
+    pool_hosts = ()
+
     def __init__(self, id, title, connection_string,
                  zdatetime, check=None, tilevel=DEFAULT_TILEVEL,
-                 encoding='UTF-8'):
+                 encoding='UTF-8', pool_minconn=POOL_MINCONN,
+                 pool_maxidle=POOL_MAXIDLE, pool_maxconn=POOL_MAXCONN,
+                 pool_timeout=POOL_TIMEOUT, slow_query_time=0,
+                 use_prepared=None, cache_ttl=0, cache_size=CACHE_SIZE,
+                 replica_dsns=(), replica_reads='readonly', pool_hosts=(),
+                 pool_idle_timeout=0,
+                 pool_max_age=0, pool_min_ready=0, pool_validate=POOL_VALIDATE,
+                 pool_ping_after=POOL_PING_AFTER,
+                 pool_breaker_threshold=POOL_BREAKER_THRESHOLD,
+                 pool_breaker_cooldown=POOL_BREAKER_COOLDOWN):
         self.zdatetime = zdatetime
         self.id = str(id)
         self.edit(title, connection_string, zdatetime,
-                  check=check, tilevel=tilevel, encoding=encoding)
+                  check=check, tilevel=tilevel, encoding=encoding,
+                  pool_minconn=pool_minconn, pool_maxidle=pool_maxidle,
+                  pool_maxconn=pool_maxconn, pool_timeout=pool_timeout,
+                  slow_query_time=slow_query_time, use_prepared=use_prepared,
+                  cache_ttl=cache_ttl, cache_size=cache_size,
+                  replica_dsns=replica_dsns, replica_reads=replica_reads,
+                  pool_hosts=pool_hosts,
+                  pool_idle_timeout=pool_idle_timeout,
+                  pool_max_age=pool_max_age, pool_min_ready=pool_min_ready,
+                  pool_validate=pool_validate, pool_ping_after=pool_ping_after,
+                  pool_breaker_threshold=pool_breaker_threshold,
+                  pool_breaker_cooldown=pool_breaker_cooldown)
 
     def factory(self):
         return DB
@@ -86,24 +194,76 @@ class Connection(Shared.DC.ZRDB.Connection.Connection):
     ## connection parameters editing ##
 
     def edit(self, title, connection_string,
-             zdatetime, check=None, tilevel=DEFAULT_TILEVEL, encoding='UTF-8'):
+             zdatetime, check=None, tilevel=DEFAULT_TILEVEL, encoding='UTF-8',
+             pool_minconn=POOL_MINCONN, pool_maxidle=POOL_MAXIDLE,
+             pool_maxconn=POOL_MAXCONN, pool_timeout=POOL_TIMEOUT,
+             slow_query_time=0, use_prepared=None, cache_ttl=0,
+             cache_size=CACHE_SIZE, replica_dsns=(), replica_reads='readonly',
+             pool_hosts=(),
+             pool_idle_timeout=0, pool_max_age=0, pool_min_ready=0,
+             pool_validate=POOL_VALIDATE, pool_ping_after=POOL_PING_AFTER,
+             pool_breaker_threshold=POOL_BREAKER_THRESHOLD,
+             pool_breaker_cooldown=POOL_BREAKER_COOLDOWN):
         self.title = title
         self.connection_string = connection_string
         self.zdatetime = zdatetime
         self.tilevel = tilevel
         self.encoding = encoding
+        self.pool_minconn = pool_minconn
+        self.pool_maxidle = pool_maxidle
+        self.pool_maxconn = pool_maxconn
+        self.pool_timeout = pool_timeout
+        self.pool_idle_timeout = pool_idle_timeout
+        self.pool_max_age = pool_max_age
+        self.pool_min_ready = pool_min_ready
+        self.pool_validate = pool_validate
+        self.pool_ping_after = pool_ping_after
+        self.pool_breaker_threshold = pool_breaker_threshold
+        self.pool_breaker_cooldown = pool_breaker_cooldown
+        self.slow_query_time = slow_query_time
+        self.use_prepared = use_prepared
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.replica_dsns = tuple([dsn.strip() for dsn in replica_dsns
+                                   if dsn.strip()])
+        self.replica_reads = replica_reads
+        self.pool_hosts = tuple([host.strip() for host in pool_hosts
+                                 if host.strip()])
 
         if check:
             self.connect(self.connection_string)
+            # report the connection errors right now
+            self._v_database_connection.open(lazy=False)
 
     manage_properties = HTMLFile('dtml/edit', globals())
 
     def manage_edit(self, title, connection_string,
                     zdatetime=None, check=None, tilevel=DEFAULT_TILEVEL,
-                    encoding='UTF-8', REQUEST=None):
+                    encoding='UTF-8', pool_minconn=POOL_MINCONN,
+                    pool_maxidle=POOL_MAXIDLE, pool_maxconn=POOL_MAXCONN,
+                    pool_timeout=POOL_TIMEOUT, slow_query_time=0,
+                    use_prepared=None, cache_ttl=0, cache_size=CACHE_SIZE,
+                    replica_dsns=(), replica_reads='readonly', pool_hosts=(),
+                    pool_idle_timeout=0,
+                    pool_max_age=0, pool_min_ready=0,
+                    pool_validate=POOL_VALIDATE,
+                    pool_ping_after=POOL_PING_AFTER,
+                    pool_breaker_threshold=POOL_BREAKER_THRESHOLD,
+                    pool_breaker_cooldown=POOL_BREAKER_COOLDOWN, REQUEST=None):
         """Edit the DB connection."""
         self.edit(title, connection_string, zdatetime,
-                  check=check, tilevel=tilevel, encoding=encoding)
+                  check=check, tilevel=tilevel, encoding=encoding,
+                  pool_minconn=pool_minconn, pool_maxidle=pool_maxidle,
+                  pool_maxconn=pool_maxconn, pool_timeout=pool_timeout,
+                  slow_query_time=slow_query_time, use_prepared=use_prepared,
+                  cache_ttl=cache_ttl, cache_size=cache_size,
+                  replica_dsns=replica_dsns, replica_reads=replica_reads,
+                  pool_hosts=pool_hosts,
+                  pool_idle_timeout=pool_idle_timeout,
+                  pool_max_age=pool_max_age, pool_min_ready=pool_min_ready,
+                  pool_validate=pool_validate, pool_ping_after=pool_ping_after,
+                  pool_breaker_threshold=pool_breaker_threshold,
+                  pool_breaker_cooldown=pool_breaker_cooldown)
         if REQUEST is not None:
             msg = "Connection edited."
             return self.manage_main(self, REQUEST, manage_tabs_message=msg)
@@ -122,7 +282,18 @@ class Connection(Shared.DC.ZRDB.Connection.Connection):
 
         # TODO: let the psycopg exception propagate, or not?
         self._v_database_connection = dbf(
-            self.connection_string, self.tilevel, self.get_type_casts(), self.encoding)
+            self.connection_string, self.tilevel, self.get_type_casts(),
+            self.encoding, minconn=self.pool_minconn,
+            maxidle=self.pool_maxidle, maxconn=self.pool_maxconn,
+            timeout=self.pool_timeout, slow_query_time=self.slow_query_time,
+            use_prepared=bool(self.use_prepared), cache_ttl=self.cache_ttl,
+            cache_size=self.cache_size, replicas=self.replica_dsns,
+            replica_reads=self.replica_reads,
+            hosts=self.pool_hosts, idle_timeout=self.pool_idle_timeout,
+            max_age=self.pool_max_age, min_ready=self.pool_min_ready,
+            validate=self.pool_validate, ping_after=self.pool_ping_after,
+            breaker_threshold=self.pool_breaker_threshold,
+            breaker_cooldown=self.pool_breaker_cooldown)
         self._v_database_connection.open()
         self._v_connected = DateTime()
 
@@ -137,13 +308,55 @@ class Connection(Shared.DC.ZRDB.Connection.Connection):
 
     ## browsing and table/column management ##
 
-    manage_options = Shared.DC.ZRDB.Connection.Connection.manage_options
-    # + (
-    #    {'label': 'Browse', 'action':'manage_browse'},)
+    manage_options = Shared.DC.ZRDB.Connection.Connection.manage_options + (
+        {'label': 'Pool', 'action': 'manage_pool'},
+        # {'label': 'Browse', 'action':'manage_browse'},
+        )
+
+    __ac_permissions__ = (
+        ('View management screens',
+         ('manage_pool', 'getPoolStats', 'getReplicaPoolStats',
+          'getCacheStats', 'getDateTimeCacheStats')),
+        ('Use Database Methods', ('readOnlyTransaction',)),)
 
     #manage_tables = HTMLFile('dtml/tables', globals())
     #manage_browse = HTMLFile('dtml/browse', globals())
 
+    ## connection pool monitoring ##
+
+    manage_pool = HTMLFile('dtml/pool', globals())
+
+    def getPoolStats(self):
+        """Return the statistics of the connection pool as a dict."""
+        return getstats(self.connection_string)
+
+    def readOnlyTransaction(self):
+        """Declare the current transaction read-only.
+
+        If there are replicas the rest of the transaction reads from one of
+        them.
+        """
+        self().set_readonly()
+
+    def getReplicaPoolStats(self):
+        """Return the statistics of the replicas connection pools.
+
+        Return a list with a dict for every replica, empty if its pool has
+        not been created yet.
+        """
+        return [getstats(dsn) for dsn in self.replica_dsns]
+
+    def getCacheStats(self):
+        """Return the statistics of the query results cache as a dict."""
+        try:
+            return self._v_database_connection.cache_stats()
+        except AttributeError:
+            return {}
+
+    def getDateTimeCacheStats(self):
+        """Return the statistics of the DateTime typecasters cache."""
+        return datetime_cache.stats()
+
     info = None
 
     def table_info(self):
@@ -175,6 +388,8 @@ class Connection(Shared.DC.ZRDB.Connection.Connection):
                 pass
         return res
 
+InitializeClass(Connection)
+
 
 def check_psycopg_version(version):
     """
@@ -219,13 +434,88 @@ for icon in ('table', 'view', 'stable', 'what', 'field', 'text', 'bin',
 
 ## zope-specific psycopg typecasters ##
 
+# default number of DateTime objects kept by the typecasters for reuse,
+# see set_datetime_cache_size()
+DATETIME_CACHE_SIZE = 10000
+
+
+class DateTimeCache(object):
+    """A thread-safe LRU cache of DateTime objects built from strings.
+
+    Parsing is slow and the same values are often repeated in the results.
+    DateTime objects are immutable so they can be shared.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, s):
+        """Return DateTime(s), cached if possible."""
+        self._lock.acquire()
+        try:
+            dt = self._data.pop(s, None)
+            if dt is not None:
+                self._data[s] = dt
+                self.hits += 1
+                return dt
+        finally:
+            self._lock.release()
+
+        dt = DateTime(s)
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._data[s] = dt
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+        return dt
+
+    def resize(self, size):
+        """Keep up to 'size' objects, discarding the least recently used."""
+        self._lock.acquire()
+        try:
+            self.size = size
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a dict with the cache size and hit counters."""
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return dict(size=self.size, entries=len(self._data),
+                        hits=self.hits, misses=self.misses,
+                        hit_rate=lookups and float(self.hits) / lookups)
+        finally:
+            self._lock.release()
+
+datetime_cache = DateTimeCache(DATETIME_CACHE_SIZE)
+
+
+def set_datetime_cache_size(size):
+    """Set the number of DateTime objects kept by the typecasters.
+
+    The cache is shared by all the connections of the process, so this is
+    meant to be called once, e.g. by a product initialization; 0 disables
+    the cache.
+    """
+    datetime_cache.resize(size)
+
+
 # convert an ISO timestamp string from postgres to a Zope DateTime object
 def _cast_DateTime(iso, curs):
     if iso:
         if iso in ['-infinity', 'infinity']:
             return iso
         else:
-            return DateTime(iso)
+            return datetime_cache(iso)
 
 
 # convert an ISO date string from postgres to a Zope DateTime object
@@ -234,7 +524,21 @@ def _cast_Date(iso, curs):
         if iso in ['-infinity', 'infinity']:
             return iso
         else:
-            return DateTime(iso)
+            return datetime_cache(iso)
+
+
+# the date of today as 'YYYY-MM-DD ', computed once per second
+_today = (None, None)
+
+
+def _today_prefix():
+    global _today
+    now = int(time.time())
+    second, prefix = _today
+    if second != now:
+        prefix = time.strftime('%Y-%m-%d ', time.localtime(now))
+        _today = (now, prefix)
+    return prefix
 
 
 # Convert a time string from postgres to a Zope DateTime object.
@@ -244,11 +548,17 @@ def _cast_Time(iso, curs):
     if iso:
         if iso in ['-infinity', 'infinity']:
             return iso
+        hms = iso[:8]
+        # postgres always returns HH:MM:SS: check it without strptime
+        if (len(hms) == 8 and hms[2] == hms[5] == ':'
+                and (hms[:2] + hms[3:5] + hms[6:]).isdigit()
+                and hms[:2] < '24' and hms[3:5] < '60' and hms[6:] < '60'):
+            return datetime_cache(_today_prefix() + hms)
         else:
             return DateTime(
                 time.strftime('%Y-%m-%d %H:%M:%S',
                               time.localtime(time.time())[:3] +
-                              time.strptime(iso[:8], "%H:%M:%S")[3:]))
+                              time.strptime(hms, "%H:%M:%S")[3:]))
 
 
 # NOTE: we don't cast intervals anymore because they are passed
@@ -15,8 +15,17 @@
 # Import modules needed by _psycopg to allow tools like py2exe to do
 # their work without bothering about the module dependencies.
 
+import re
+import sys
+import time
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+
 from Shared.DC.ZRDB.TM import TM
 from Shared.DC.ZRDB import dbi_db
+from Shared.DC.ZRDB.DA import DA as SQLMethod
 
 from ZODB.POSException import ConflictError
 
@@ -25,8 +34,396 @@ import pool
 import psycopg2
 from psycopg2.extensions import INTEGER, LONGINTEGER, BOOLEAN, DATE, TIME
 from psycopg2.extensions import TransactionRollbackError, register_type
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extensions import ISOLATION_LEVEL_SERIALIZABLE
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+from psycopg2.errorcodes import READ_ONLY_SQL_TRANSACTION
 from psycopg2 import NUMBER, STRING, ROWID, DATETIME
 
+try:
+    from psycopg2.extras import execute_batch, execute_values
+except ImportError:
+    # psycopg < 2.7
+    execute_batch = execute_values = None
+
+logger = logging.getLogger('ZPsycopgDA')
+
+# maximum number of prepared statements kept on each connection
+PREPARED_STATEMENTS = 100
+
+# statements that can be prepared and query placeholders
+_preparable = re.compile(r'\s*(select|insert|update|delete|values|with)\b',
+                         re.IGNORECASE)
+_placeholder = re.compile(r'%(?:\((\w+)\))?s|%%')
+
+# seconds to wait before running again a read interrupted by a lost
+# connection, e.g. on a database failover or a pgbouncer restart
+RETRY_DELAY = 0.05
+
+# default number of records fetched at once by iterquery()
+ITERSIZE = 2000
+
+# default number of parameter sets sent at once by executemany()
+PAGE_SIZE = 100
+
+# size of the chunks of data exchanged by copy_in() and copy_out()
+COPY_SIZE = 64 * 1024
+
+# maximum number of converted descriptions remembered
+DESCRIPTIONS = 1000
+
+# numbers naming the server-side cursors: unlike a generator, count() can
+# be advanced by several threads at once
+_cursor_ids = itertools.count(1)
+
+# turns used to choose among equally loaded replicas
+_replica_turns = itertools.count()
+
+# default memory limit of the result cache, in bytes
+CACHE_SIZE = 8 * 1024 * 1024
+
+# statements whose results can be cached, unless calling functions whose
+# result changes at every call, and tables changed by a statement
+_readonly = re.compile(r'\s*(select|values)\b', re.IGNORECASE)
+_locking = re.compile(r'\b(into|for\s+(no\s+key\s+)?update|for\s+(key\s+)?share)\b',
+                      re.IGNORECASE)
+_volatile = re.compile(
+    r'\b(nextval|setval|currval|lastval|random|gen_random_uuid'
+    r'|uuid_generate_\w+|now|clock_timestamp|statement_timestamp'
+    r'|transaction_timestamp|timeofday|current_date|current_time'
+    r'|current_timestamp|localtime|localtimestamp|txid_current\w*'
+    r'|pg_advisory\w*|pg_try_advisory\w*)\b',
+    re.IGNORECASE)
+# statements changing the data, invalidating the cached results
+_modifying = re.compile(
+    r'\s*(insert|update|delete|merge|truncate|copy|create|drop|alter|comment'
+    r'|grant|revoke|security\s+label|refresh|reindex|cluster|import|call|do)\b',
+    re.IGNORECASE)
+# statements that may run a data-modifying one (EXPLAIN ANALYZE does)
+_nesting = re.compile(r'\s*(with|explain)\b', re.IGNORECASE)
+_nested_modifying = re.compile(r'\b(insert|update|delete|merge)\b',
+                               re.IGNORECASE)
+_written = re.compile(
+    r'\s*(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?)'
+    r'\s+(?:only\s+)?([\w."]+)', re.IGNORECASE)
+_batchable = re.compile(
+    r'\s*(insert|update|delete|create|drop|alter|truncate|grant|revoke|lock'
+    r'|comment|set|reset)\b', re.IGNORECASE)
+_returning = re.compile(r'\breturning\b', re.IGNORECASE)
+_values = re.compile(r'\bvalues\s+%s', re.IGNORECASE)
+_literal = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""")
+
+
+def _caller_id():
+    """Return the id of the SQL Method running the query, if any."""
+    f = sys._getframe(1)
+    while f is not None:
+        obj = f.f_locals.get('self')
+        if isinstance(obj, SQLMethod):
+            return obj.getId()
+        f = f.f_back
+    return None
+
+
+def _normalize(query_string):
+    """Collapse the whitespaces of a query outside of the quoted strings."""
+    if '\\' in query_string:
+        # don't risk with escaped quotes
+        return query_string
+    return _literal.sub(lambda m: m.group(1) or ' ', query_string).strip()
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s can't be changed" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+
+# converted descriptions, see DB.convert_description()
+_descriptions = {}
+
+
+# queries, as opposed to table names, passed to copy_out()
+_copy_query = re.compile(r'\s*(select|values|with)\b', re.IGNORECASE)
+
+
+def _quote_ident(name):
+    """Quote a possibly schema-qualified identifier, unless already quoted."""
+    if '"' in name:
+        return name
+    return '.'.join(['"%s"' % part for part in name.split('.')])
+
+
+class CopyReader(object):
+    """File-like object reading the records of an iterable in COPY format.
+
+    'format' can be 'text' or 'csv'; unicode values are encoded in
+    'encoding'.
+    """
+
+    _escapes = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+                ('\r', '\\r'))
+
+    def __init__(self, rows, format='text', encoding='utf-8'):
+        if format not in ('text', 'csv'):
+            raise ValueError("bad COPY format: %s" % format)
+        self.format = format
+        self.encoding = encoding
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def _value(self, value):
+        if value is None:
+            return self.format == 'text' and '\\N' or ''
+        if isinstance(value, unicode):
+            value = value.encode(self.encoding)
+        elif isinstance(value, float):
+            # str() keeps only 12 significant digits
+            value = repr(value)
+        else:
+            value = str(value)
+        if self.format == 'text':
+            for c, e in self._escapes:
+                value = value.replace(c, e)
+            return value
+        else:
+            return '"%s"' % value.replace('"', '""')
+
+    def _line(self, row):
+        sep = self.format == 'text' and '\t' or ','
+        return sep.join(map(self._value, row)) + '\n'
+
+    def read(self, size=-1):
+        lines = [self._buffer]
+        length = len(self._buffer)
+        for row in self._rows:
+            line = self._line(row)
+            lines.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(lines)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class CopyWriter(object):
+    """File-like object passing data to 'writable' in chunks of 'size'."""
+
+    def __init__(self, writable, size=COPY_SIZE):
+        self.writable = writable
+        self.size = size
+        self._buffer = []
+        self._length = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._length += len(data)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.writable.write(''.join(self._buffer))
+            self._buffer = []
+            self._length = 0
+
+
+# string literals, quoted identifiers and comments, which may contain ';'
+_sql_literals = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/"
+    r"|\$(\w*)\$.*?\$\1\$", re.DOTALL)
+
+
+def _single_statement(qs):
+    """Return 'qs' without a trailing ';', None if not a single statement.
+
+    None is also returned if 'qs' can't be parsed safely.
+    """
+    if '\\' in qs:
+        # maybe escapes in E'' strings
+        return None
+    # blank the literals keeping the positions
+    code = _sql_literals.sub(lambda m: ' ' * len(m.group()), qs)
+    for token in ("'", '"', '$', '/*', '*/'):
+        if token in code:
+            return None
+    end = len(code.rstrip().rstrip(';'))
+    if ';' in code[:end]:
+        return None
+    if ';' in code:
+        # drop the ';' and what follows it, e.g. a comment
+        return qs[:code.index(';')]
+    return qs
+
+
+def _limited(qs, max_rows):
+    """Return 'qs' changed to return at most 'max_rows' records if possible.
+
+    The limit is applied by the server, so the other records are not
+    transferred, without extra round trips. 'qs' is left unchanged unless
+    it is a single SELECT or VALUES.
+    """
+    if not max_rows or not _readonly.match(qs) or _locking.search(qs):
+        return qs
+    single = _single_statement(qs)
+    if single is None:
+        return qs
+    # the newline ends a trailing comment
+    return 'SELECT * FROM (%s\n) AS zpsycopg_limited LIMIT %d' % (
+        single, max_rows)
+
+
+def _join_statements(statements):
+    """Merge the statements that can be sent to the server together.
+
+    Every run of statements returning no result (e.g. INSERT without
+    RETURNING) is merged with the statement following it.
+    """
+    batch = []
+    for qs in statements:
+        batch.append(qs)
+        if not _batchable.match(qs) or _returning.search(qs):
+            yield '\n;\n'.join(batch)
+            batch = []
+    if batch:
+        yield '\n;\n'.join(batch)
+
+
+def _changed_tables(statements):
+    """Return the tables changed by the statements (None if unknown)."""
+    tables = []
+    for qs in statements:
+        if _modifying.match(qs) or \
+                _nesting.match(qs) and _nested_modifying.search(qs):
+            m = _written.match(qs)
+            tables.append(m and m.group(1))
+    return tables
+
+
+def _sizeof(rows):
+    """Estimate the memory used by a list of records."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+class ResultCache(object):
+    """A LRU cache of query results with expiry time and size limit.
+
+    Results are kept for 'ttl' seconds; when the estimated size of the
+    cached results exceeds 'maxsize' bytes the least recently used ones are
+    discarded.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._data = OrderedDict()  # key -> (expiry, size, query, result)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the result cached for 'key', None if missing or expired."""
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                self.size -= entry[1]
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, query, result):
+        """Cache the 'result' of 'query' with 'key'."""
+        size = _sizeof(result[1])
+        if size > self.maxsize:
+            return
+        self._lock.acquire()
+        try:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            while self._data and self.size + size > self.maxsize:
+                self.size -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+            self._data[key] = (time.time() + self.ttl, size,
+                               query.lower(), result)
+            self.size += size
+        finally:
+            self._lock.release()
+
+    def invalidate(self, tables=None):
+        """Discard the results of the queries mentioning one of 'tables'.
+
+        Discard all the results if 'tables' is None or contains None.
+        """
+        self._lock.acquire()
+        try:
+            if tables is None or None in tables:
+                self.invalidations += len(self._data)
+                self._data.clear()
+                self.size = 0
+                return
+            names = [t.lower().split('.')[-1].strip('"') for t in tables]
+            for key, entry in self._data.items():
+                for name in names:
+                    if name in entry[2]:
+                        del self._data[key]
+                        self.size -= entry[1]
+                        self.invalidations += 1
+                        break
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a dict with the cache settings and counters."""
+        self._lock.acquire()
+        try:
+            return dict(ttl=self.ttl, maxsize=self.maxsize, size=self.size,
+                        entries=len(self._data), hits=self.hits,
+                        misses=self.misses, evictions=self.evictions,
+                        invalidations=self.invalidations)
+        finally:
+            self._lock.release()
+
+
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+
+def getcache(key, ttl, maxsize):
+    """Return the result cache shared by the DB objects with equal 'key'."""
+    _result_caches_lock.acquire()
+    try:
+        cache = _result_caches.get(key)
+        if cache is None:
+            cache = _result_caches[key] = ResultCache(ttl, maxsize)
+        return cache
+    finally:
+        _result_caches_lock.release()
+
 
 # the DB object, managing all the real query work
 
@@ -34,71 +431,236 @@ class DB(TM, dbi_db.DB):
 
     _p_oid = _p_changed = _registered = None
 
-    def __init__(self, dsn, tilevel, typecasts, enc='utf-8'):
+    def __init__(self, dsn, tilevel, typecasts, enc='utf-8',
+                 minconn=pool.POOL_MINCONN, maxidle=pool.POOL_MAXIDLE,
+                 maxconn=pool.POOL_MAXCONN, timeout=pool.POOL_TIMEOUT,
+                 slow_query_time=0, use_prepared=False,
+                 cache_ttl=0, cache_size=CACHE_SIZE, replicas=(), hosts=(),
+                 replica_reads='readonly', idle_timeout=0, max_age=0,
+                 min_ready=0,
+                 validate=pool.POOL_VALIDATE, ping_after=pool.POOL_PING_AFTER,
+                 breaker_threshold=pool.POOL_BREAKER_THRESHOLD,
+                 breaker_cooldown=pool.POOL_BREAKER_COOLDOWN):
         self.dsn = dsn
+        self.replicas = tuple(replicas)
+        self.replica_reads = replica_reads
         self.tilevel = tilevel
         self.typecasts = typecasts
         if enc is None or enc == "":
             self.encoding = "utf-8"
         else:
             self.encoding = enc
+        # the pools are created without waiting for minconn connections
+        self.pool_settings = dict(minconn=minconn, maxidle=maxidle,
+                                  maxconn=maxconn, timeout=timeout,
+                                  idle_timeout=idle_timeout, max_age=max_age,
+                                  min_ready=min_ready, validate=validate,
+                                  ping_after=ping_after,
+                                  breaker_threshold=breaker_threshold,
+                                  breaker_cooldown=breaker_cooldown,
+                                  lazy=True)
+        # the hosts alternatives only apply to the primary database
+        self.replica_settings = dict(self.pool_settings)
+        self.pool_settings['hosts'] = tuple(hosts)
+        self.slow_query_time = slow_query_time
+        self.use_prepared = use_prepared
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._changed = None  # tables written in the transaction
+        self._dsns = []       # databases used in the transaction
+        self._replica = None  # replica read by the transaction
+        self._wrote = False   # the transaction executed a write
+        self._readonly = False  # the transaction was declared read-only
         self.failures = 0
         self.calls = 0
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
         self.make_mappings()
 
-    def getconn(self, init=True):
+    def getconn(self, init=True, dsn=None):
         # if init is False we are trying to get hold on an already existing
         # connection, so we avoid to (re)initialize it risking errors.
-        conn = pool.getconn(self.dsn)
+        if dsn is None:
+            dsn = self.dsn
+        if dsn == self.dsn:
+            conn = pool.getconn(dsn, **self.pool_settings)
+        else:
+            conn = pool.getconn(dsn, **self.replica_settings)
         if init:
+            if dsn not in self._dsns:
+                self._dsns.append(dsn)
+            tilevel = int(self.tilevel)
+            if dsn != self.dsn and tilevel == ISOLATION_LEVEL_SERIALIZABLE:
+                # serializable transactions can't run on a hot standby
+                tilevel = ISOLATION_LEVEL_REPEATABLE_READ
+            # the pool remembers what every connection was initialized with,
+            # so the setup queries are only issued if something changed.
+            # Typecasts don't compare safely with other objects: use their id.
+            state = pool.connstate(dsn, conn)
+            setup = (tilevel, self.encoding, tuple(map(id, self.typecasts)))
+            if state.get('setup') == setup:
+                return conn
+            # the session can't be changed in the middle of a transaction
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                return conn
             # use set_session where available as in these versions
             # set_isolation_level generates an extra query.
             if psycopg2.__version__ >= '2.4.2':
-                conn.set_session(isolation_level=int(self.tilevel))
+                conn.set_session(isolation_level=tilevel)
             else:
-                conn.set_isolation_level(int(self.tilevel))
+                conn.set_isolation_level(tilevel)
             conn.set_client_encoding(self.encoding)
             for tc in self.typecasts:
                 register_type(tc, conn)
+            state['setup'] = setup
         return conn
 
-    def putconn(self, close=False):
+    def putconn(self, close=False, dsn=None):
+        if dsn is None:
+            dsn = self.dsn
         try:
-            conn = pool.getconn(self.dsn, False)
+            conn = pool.getconn(dsn, False)
         except AttributeError:
             pass
-        pool.putconn(self.dsn, conn, close)
+        pool.putconn(dsn, conn, close)
 
-    def getcursor(self):
-        conn = self.getconn(False)
+    def getcursor(self, dsn=None):
+        # initialization is cheap for a connection already set up, so make
+        # sure every connection handed out by the pool is initialized.
+        conn = self.getconn(dsn=dsn)
         return conn.cursor()
 
-    def _finish(self, *ignored):
+    def set_readonly(self):
+        """Declare the current transaction read-only.
+
+        If there are replicas the rest of the transaction reads from one of
+        them. Should the transaction write something anyway, the writes run
+        on the primary, not isolated from the reads done on the replica.
+        """
+        self._register()
+        self._readonly = True
+
+    def _route(self, readonly):
+        """Return the DSN of the database to run a statement on.
+
+        If there are replicas, read-only statements of the transactions
+        declared read-only run on one of them. If 'replica_reads' is
+        'before_write' the statements of any transaction run on a replica
+        until the transaction writes something, then on the primary so that
+        the transaction reads its own writes: the reads done before the
+        first write are then not isolated from it, e.g. a read-modify-write
+        sequence can lose updates without raising a ConflictError.
+        """
+        if not readonly:
+            self._wrote = True
+        if self._wrote or not self.replicas:
+            return self.dsn
+        if not self._readonly and self.replica_reads != 'before_write':
+            return self.dsn
+        if self._replica is None:
+            # the least busy replica, taking turns on a tie
+            n = _replica_turns.next() % len(self.replicas)
+            replicas = self.replicas[n:] + self.replicas[:n]
+            replica = min(replicas, key=pool.inuse)
+            try:
+                self.getconn(dsn=replica)
+            except (psycopg2.Error, pool.PoolError), err:
+                logger.warning("replica %d unavailable, reading from the "
+                               "primary: %s",
+                               self.replicas.index(replica) + 1, err)
+                if replica in self._dsns:
+                    # connected but not initialized
+                    self._dsns.remove(replica)
+                    self.putconn(True, replica)
+                replica = self.dsn
+            self._replica = replica
+        return self._replica
+
+    def _leave_replica(self):
+        """Roll back the replica transaction and use the primary."""
         try:
-            conn = self.getconn(False)
-            conn.commit()
-            self.putconn()
-        except AttributeError:
-            pass
+            self.getconn(False, self._replica).rollback()
+            self.putconn(dsn=self._replica)
+        except psycopg2.Error:
+            self.putconn(True, self._replica)
+        self._dsns.remove(self._replica)
+        self._wrote = True
+
+    def _finish(self, *ignored):
+        dsns, self._dsns = self._dsns, []
+        self._replica = None
+        self._wrote = False
+        self._readonly = False
+        for dsn in dsns:
+            try:
+                conn = self.getconn(False, dsn)
+                conn.commit()
+                self.putconn(dsn=dsn)
+            except AttributeError:
+                pass
+        if self._changed is not None:
+            # other threads may have cached what we were changing
+            self.getcache().invalidate(self._changed)
+            self._changed = None
 
     def _abort(self, *ignored):
-        try:
-            conn = self.getconn(False)
-            conn.rollback()
+        self._changed = None
+        dsns, self._dsns = self._dsns, []
+        self._replica = None
+        self._wrote = False
+        self._readonly = False
+        for dsn in dsns:
+            try:
+                conn = self.getconn(False, dsn)
+                conn.rollback()
+                self.putconn(dsn=dsn)
+            except (AttributeError, psycopg2.Error, pool.PoolError):
+                # roll back the other databases all the same
+                pass
+
+    def open(self, lazy=True):
+        """Create the connection pool for our DSN if not already existing.
+
+        The pool connections are opened in background. If 'lazy' is false,
+        also get and immediately release a connection, to find out at once
+        if the database can be reached.
+        """
+        if lazy:
+            pool.getpool(self.dsn, **self.pool_settings)
+        else:
+            self.getconn()
             self.putconn()
-        except AttributeError:
-            pass
 
-    def open(self):
-        # this will create a new pool for our DSN if not already existing,
-        # then get and immediately release a connection
-        self.getconn()
-        self.putconn()
+    def cache_stats(self):
+        """Return the result cache settings and counters, {} if disabled."""
+        cache = self.getcache()
+        if cache is None:
+            return {}
+        return cache.stats()
+
+    def getcache(self):
+        """Return the cache of the query results, None if disabled.
+
+        The cache is shared by the DB objects with the same settings, e.g.
+        the copies of the same Database Connection in different threads.
+        """
+        if not self.cache_ttl:
+            return None
+        return getcache(
+            (self.dsn, self.encoding, tuple(map(id, self.typecasts)),
+             self.cache_ttl, self.cache_size),
+            self.cache_ttl, self.cache_size)
 
     def close(self):
         # FIXME: if this connection is closed we flush all the pool associated
         # with the current DSN; does this makes sense?
         pool.flushpool(self.dsn)
+        for dsn in self.replicas:
+            try:
+                pool.flushpool(dsn)
+            except KeyError:
+                # never used
+                pass
 
     def sortKey(self):
         return 1
@@ -113,18 +675,33 @@ class DB(TM, dbi_db.DB):
                 self.type_mappings[v] = (t, s)
 
     def convert_description(self, desc, use_psycopg_types=False):
-        """Convert DBAPI-2.0 description field to Zope format."""
+        """Convert DBAPI-2.0 description field to Zope format.
+
+        The result is shared by all the queries with the same description
+        and can't be modified.
+        """
+        key = (tuple(map(tuple, desc)), bool(use_psycopg_types))
+        try:
+            return _descriptions[key]
+        except KeyError:
+            pass
+
         items = []
         for name, typ, width, ds, p, scale, null_ok in desc:
             m = self.type_mappings.get(typ, (STRING, 's'))
-            items.append({
+            items.append(FrozenDict({
                 'name': name,
                 'type': use_psycopg_types and m[0] or m[1],
                 'width': width,
                 'precision': p,
                 'scale': scale,
                 'null': null_ok,
-            })
+            }))
+        items = tuple(items)
+
+        if len(_descriptions) >= DESCRIPTIONS:
+            _descriptions.clear()
+        _descriptions[key] = items
         return items
 
     ## tables and rows ##
@@ -160,20 +737,311 @@ class DB(TM, dbi_db.DB):
 
     ## query execution ##
 
+    def executemany(self, query_string, seq_of_parameters,
+                    page_size=PAGE_SIZE, template=None):
+        """Execute a statement for every parameters set in a sequence.
+
+        The statements are sent to the server in batches of 'page_size'. If
+        the statement contains a 'VALUES %s' placeholder, such as in
+        'INSERT INTO table (a, b) VALUES %s', the parameters of a batch are
+        merged into a single multi-row VALUES clause, using 'template' for
+        every record (see psycopg2.extras.execute_values()).
+        """
+        self._register()
+        self.calls = self.calls+1
+
+        cache = self.getcache()
+        if cache is not None:
+            self._invalidate(cache, _changed_tables([query_string]))
+
+        c = self.getcursor(self._route(False))
+        try:
+            start = time.time()
+            try:
+                if _values.search(query_string):
+                    if execute_values is not None:
+                        execute_values(c, query_string, seq_of_parameters,
+                                       template, page_size)
+                    else:
+                        c.executemany(query_string,
+                                      [(args,) for args in seq_of_parameters])
+                elif execute_batch is not None:
+                    execute_batch(c, query_string, seq_of_parameters,
+                                  page_size)
+                else:
+                    c.executemany(query_string, seq_of_parameters)
+            except TransactionRollbackError:
+                raise ConflictError("TransactionRollbackError from psycopg2")
+            executed = time.time()
+            self._timed(query_string, start, executed, executed, c.rowcount)
+        except StandardError, err:
+            self._abort()
+            raise err
+
+    def copy_in(self, table, rows, columns=None, format='text',
+                size=COPY_SIZE):
+        """Load the records of the 'rows' iterable into 'table' using COPY.
+
+        'columns' is the list of the columns of the records, if not all the
+        table columns. The records are sent to the server in chunks of
+        'size' bytes in 'text' or 'csv' format.
+        """
+        self._register()
+        self.calls = self.calls+1
+
+        sql = 'COPY %s' % _quote_ident(table)
+        if columns:
+            sql += ' (%s)' % ', '.join(map(_quote_ident, columns))
+        sql += ' FROM STDIN'
+        if format == 'csv':
+            sql += ' CSV'
+        reader = CopyReader(rows, format, self.encoding)
+
+        cache = self.getcache()
+        if cache is not None:
+            self._invalidate(cache, [table])
+
+        c = self.getcursor(self._route(False))
+        try:
+            start = time.time()
+            try:
+                c.copy_expert(sql, reader, size)
+            except TransactionRollbackError:
+                raise ConflictError("TransactionRollbackError from psycopg2")
+            executed = time.time()
+            self._timed(sql, start, executed, executed, c.rowcount)
+        except StandardError, err:
+            self._abort()
+            raise err
+
+    def copy_out(self, query, writable, format='text', header=False,
+                 size=COPY_SIZE):
+        """Write the result of 'query' to 'writable' using COPY.
+
+        'query' is a SELECT or a table name. The data, in 'text' or 'csv'
+        format (with a header line if 'header' is true), is passed to the
+        'write()' method of 'writable' in chunks of about 'size' bytes as
+        it is received from the server, so it can be e.g. a Zope RESPONSE.
+        """
+        self._register()
+        self.calls = self.calls+1
+
+        if format not in ('text', 'csv'):
+            raise ValueError("bad COPY format: %s" % format)
+        if _copy_query.match(query):
+            sql = 'COPY (%s) TO STDOUT' % query
+        else:
+            sql = 'COPY %s TO STDOUT' % _quote_ident(query)
+        if format == 'csv':
+            sql += header and ' CSV HEADER' or ' CSV'
+        writer = CopyWriter(writable, size)
+
+        c = self.getcursor(self._route(True))
+        try:
+            start = time.time()
+            try:
+                c.copy_expert(sql, writer, size)
+            except TransactionRollbackError:
+                raise ConflictError("TransactionRollbackError from psycopg2")
+            writer.flush()
+            executed = time.time()
+            self._timed(sql, start, executed, executed, c.rowcount)
+        except StandardError, err:
+            self._abort()
+            raise err
+
+    def iterquery(self, query_string, query_data=None, itersize=ITERSIZE):
+        """Execute a SELECT and return its description and an iterator.
+
+        The query is executed by a server-side cursor: the iterator yields
+        lists of at most 'itersize' records, fetched from the server only
+        when needed, so that large results don't need to fit in memory.
+        The records must be consumed before the end of the transaction.
+        """
+        self._register()
+        self.calls = self.calls+1
+
+        name = 'zpsycopg_cursor_%d' % _cursor_ids.next()
+        c = self.getconn(dsn=self._route(True)).cursor(name)
+        try:
+            start = time.time()
+            try:
+                c.execute(query_string, query_data)
+                rows = c.fetchmany(itersize)
+            except TransactionRollbackError:
+                raise ConflictError("TransactionRollbackError from psycopg2")
+            executed = time.time()
+            self._timed(query_string, start, executed, executed, len(rows))
+            desc = c.description
+        except StandardError, err:
+            self._abort()
+            raise err
+
+        def chunks(rows):
+            try:
+                while rows:
+                    yield rows
+                    rows = c.fetchmany(itersize)
+            finally:
+                try:
+                    c.close()
+                except psycopg2.Error:
+                    # the transaction is already finished
+                    pass
+
+        return self.convert_description(desc), chunks(rows)
+
+    def _invalidate(self, cache, changed):
+        """Discard the cached results of queries on the 'changed' tables."""
+        if not changed:
+            return
+        # don't read from the cache for the rest of the transaction
+        self._changed = (self._changed or []) + changed
+        cache.invalidate(changed)
+
+    def _prepared(self, c, qs, query_data, dsn=None):
+        """Return the query and arguments to execute 'qs' as prepared.
+
+        The statement is prepared on the cursor connection, from the pool of
+        'dsn', if not already done: every connection keeps the
+        PREPARED_STATEMENTS statements most recently used and deallocates
+        the others. If the statement can't be prepared return the arguments
+        unchanged: the statements the server fails to prepare (e.g. if the
+        type of a parameter can't be inferred) are remembered as such.
+        """
+        if isinstance(query_data, dict):
+            values = query_data.values()
+        else:
+            values = query_data
+        for value in values:
+            # e.g. 'IN %s' with a tuple: only valid with the value inline
+            if isinstance(value, (tuple, list, dict)) or \
+                    hasattr(value, 'getquoted'):
+                return qs, query_data
+
+        state = pool.connstate(dsn or self.dsn, c.connection)
+        prepared = state.get('prepared')
+        if prepared is None:
+            prepared = state['prepared'] = OrderedDict()
+
+        try:
+            entry = prepared.pop(qs)
+        except KeyError:
+            if not _preparable.match(qs):
+                return qs, query_data
+
+            # convert the placeholders into $n parameters: args is the list
+            # of the argument names, None for positional arguments
+            args = []
+
+            def param(m):
+                if m.group() == '%%':
+                    return '%'
+                arg = m.group(1)
+                if arg is None or arg not in args:
+                    args.append(arg)
+                    return '$%d' % len(args)
+                return '$%d' % (args.index(arg) + 1)
+
+            stmt = _placeholder.sub(param, qs)
+            if isinstance(query_data, dict) == (None in args):
+                return qs, query_data
+
+            state['prepared_seq'] = state.get('prepared_seq', 0) + 1
+            name = 'zpsycopg_%d' % state['prepared_seq']
+            try:
+                # a failure must not abort the transaction
+                c.execute('SAVEPOINT zpsycopg_prepare;\n'
+                          'PREPARE %s AS %s;\n'
+                          'RELEASE SAVEPOINT zpsycopg_prepare' % (name, stmt))
+            except psycopg2.OperationalError:
+                raise
+            except psycopg2.Error, err:
+                c.execute('ROLLBACK TO SAVEPOINT zpsycopg_prepare')
+                logger.debug("cannot prepare statement: %s: %s", err, qs)
+                entry = None
+            else:
+                entry = name, args
+            while len(prepared) >= PREPARED_STATEMENTS:
+                old = prepared.popitem(last=False)[1]
+                if old is not None:
+                    c.execute('DEALLOCATE %s' % old[0])
+
+        prepared[qs] = entry
+        if entry is None:
+            return qs, query_data
+        name, args = entry
+        if not args:
+            return 'EXECUTE %s' % name, None
+        if isinstance(query_data, dict):
+            query_data = [query_data[arg] for arg in args]
+        return ('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))),
+                query_data)
+
+    def _timed(self, qs, start, executed, fetched, nrows):
+        """Account for the time spent on a statement, log it if slow."""
+        self.execute_time += executed - start
+        self.fetch_time += fetched - executed
+        if self.slow_query_time and \
+                fetched - start >= self.slow_query_time:
+            logger.warning(
+                "slow query from %s: execute %.3fs, fetch %.3fs, %d rows: %s",
+                _caller_id(), executed - start, fetched - executed,
+                nrows, qs)
+
     def query(self, query_string, max_rows=None, query_data=None):
         self._register()
         self.calls = self.calls+1
 
+        statements = [x for x in query_string.split('\0') if x]
+
+        cache = self.getcache()
+        if cache is not None:
+            changed = _changed_tables(statements)
+            if changed:
+                self._invalidate(cache, changed)
+                cache = None
+            elif self._changed is not None or \
+                    [qs for qs in statements
+                     if not _readonly.match(qs) or _locking.search(qs) or
+                     _volatile.search(qs)]:
+                cache = None
+            else:
+                if isinstance(query_data, dict):
+                    data = sorted(query_data.items())
+                else:
+                    data = query_data
+                key = (_normalize(query_string), max_rows, repr(data))
+                result = cache.get(key)
+                if result is not None:
+                    return result[0], list(result[1])
+
+        readonly = not [qs for qs in statements
+                        if not _readonly.match(qs) or _locking.search(qs)]
+        # a read can run again on a new connection if the transaction
+        # lost with the old one didn't write anything
+        retry = readonly and not self._wrote and not self.failures
+        dsn = self._route(readonly)
+
+        # fetch only max_rows records from the server if possible
+        statements = [_limited(qs, max_rows) for qs in statements]
+        if not query_data:
+            # save the round trips of the statements returning nothing
+            statements = _join_statements(statements)
+
         desc = ()
         res = []
         nselects = 0
 
-        c = self.getcursor()
+        c = self.getcursor(dsn)
 
         try:
-            for qs in [x for x in query_string.split('\0') if x]:
+            for qs in statements:
+                start = time.time()
                 try:
-                    if query_data:
+                    if query_data and self.use_prepared:
+                        c.execute(*self._prepared(c, qs, query_data, dsn))
+                    elif query_data:
                         c.execute(qs, query_data)
                     else:
                         c.execute(qs)
@@ -181,28 +1049,56 @@ class DB(TM, dbi_db.DB):
                     # Ha, here we have to look like we are the ZODB raising conflict errrors, raising ZPublisher.Publish.Retry just doesn't work
                     #logging.debug("Serialization Error, retrying transaction", exc_info=True)
                     raise ConflictError("TransactionRollbackError from psycopg2")
-                except psycopg2.OperationalError:
-                    #logging.exception("Operational error on connection, closing it.")
-                    try:
-                        # Only close our connection
-                        self.putconn(True)
-                    except:
-                        #logging.debug("Something went wrong when we tried to close the pool", exc_info=True)
-                        pass
-                if c.description is not None:
+                executed = time.time()
+                description = c.description
+                nrows = c.rowcount
+                if description is not None:
                     nselects += 1
-                    if c.description != desc and nselects > 1:
+                    if description != desc and nselects > 1:
                         raise psycopg2.ProgrammingError(
                             'multiple selects in single query not allowed')
                     if max_rows:
                         res = c.fetchmany(max_rows)
                     else:
                         res = c.fetchall()
-                    desc = c.description
+                    desc = description
+                    nrows = len(res)
+                self._timed(qs, start, executed, time.time(), nrows)
             self.failures = 0
 
         except StandardError, err:
+            if dsn != self.dsn and \
+                    getattr(err, 'pgcode', None) == READ_ONLY_SQL_TRANSACTION:
+                # e.g. a SELECT calling a function writing something
+                self._leave_replica()
+                self.calls = self.calls-1
+                return self.query(query_string, max_rows, query_data)
+            if isinstance(err, psycopg2.OperationalError):
+                # e.g. not a statement timeout, leaving the connection open
+                lost = c.connection.closed
+                #logging.exception("Operational error on connection, closing it.")
+                try:
+                    # Only close our connection
+                    self.putconn(True, dsn)
+                    self._dsns.remove(dsn)
+                except:
+                    #logging.debug("Something went wrong when we tried to close the pool", exc_info=True)
+                    pass
+                if retry and lost:
+                    logger.warning("connection lost, running the query "
+                                   "again: %s", err)
+                    time.sleep(RETRY_DELAY)
+                    self.calls = self.calls-1
+                    self.failures = 1
+                    try:
+                        return self.query(query_string, max_rows, query_data)
+                    finally:
+                        self.failures = 0
             self._abort()
             raise err
 
+        if cache is not None:
+            cache.set(key, query_string, (self.convert_description(desc), res))
+            res = list(res)
+
         return self.convert_description(desc), res
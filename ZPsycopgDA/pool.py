@@ -18,9 +18,164 @@
 # All the connections are held in a pool of pools, directly accessible by the
 # ZPsycopgDA code in db.py.
 
+import sys
+import time
+import logging
 import threading
+from collections import deque
+
 import psycopg2
 from psycopg2.pool import PoolError
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+
+logger = logging.getLogger('ZPsycopgDA')
+
+def parse_host(entry):
+    """Split a 'host', 'host:port' or '[address]:port' string.
+
+    Return a (host, port) tuple, port is None if not specified.
+    """
+    entry = entry.strip()
+    if entry.startswith('['):
+        host, _, port = entry[1:].partition(']')
+        port = port[1:]
+    elif entry.count(':') == 1:
+        host, port = entry.split(':')
+    else:
+        host, port = entry, ''
+    return host, port and int(port) or None
+
+
+class HostMonitor(object):
+    """Measure the latency and the availability of a set of hosts.
+
+    A background thread checks every host each 'interval' seconds, using a
+    connection obtained calling 'connect(host)', and calls 'on_down(host)'
+    when a host stops answering. Connect and round trip times are
+    exponentially weighted moving averages.
+    """
+
+    def __init__(self, hosts, connect, interval=None, on_down=None):
+        self.hosts = list(hosts)
+        self.interval = interval or HOSTS_CHECK_INTERVAL
+        self._connect = connect
+        self._on_down = on_down
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._conns = {}
+        self._stats = {}
+        for host in self.hosts:
+            self._stats[host] = dict(up=True, rtt=None, connect=None,
+                                     failures=0, checked=None)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='ZPsycopgDA host monitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def order(self):
+        """Return the hosts to try, the fastest healthy ones first.
+
+        The hosts not measured yet follow the measured ones in the order
+        they were given, the hosts down come last.
+        """
+        self._lock.acquire()
+        try:
+            def key(host):
+                st = self._stats[host]
+                return (not st['up'], st['rtt'] is None, st['rtt'])
+            return sorted(self.hosts, key=key)
+        finally:
+            self._lock.release()
+
+    def _average(self, old, value):
+        if old is None:
+            return value
+        return old + HOSTS_EWMA_WEIGHT * (value - old)
+
+    def connected(self, host, seconds):
+        """Record a successful connection to 'host' taking 'seconds'."""
+        self._lock.acquire()
+        try:
+            st = self._stats[host]
+            st['connect'] = self._average(st['connect'], seconds)
+            st['up'] = True
+            st['failures'] = 0
+        finally:
+            self._lock.release()
+
+    def failed(self, host):
+        """Record a failure of 'host'. Return True if it was up before."""
+        self._lock.acquire()
+        try:
+            st = self._stats[host]
+            st['failures'] += 1
+            was_up, st['up'] = st['up'], False
+            return was_up
+        finally:
+            self._lock.release()
+
+    def _check(self, host):
+        """Measure the round trip time of 'host'."""
+        conn = self._conns.get(host)
+        try:
+            if conn is None or conn.closed:
+                start = time.time()
+                conn = self._conns[host] = self._connect(host)
+                self.connected(host, time.time() - start)
+            start = time.time()
+            curs = conn.cursor()
+            curs.execute("SELECT 1")
+            curs.fetchone()
+            conn.rollback()
+            rtt = time.time() - start
+        except psycopg2.Error:
+            conn = self._conns.pop(host, None)
+            if conn is not None:
+                conn.close()
+            if self.failed(host) and self._on_down is not None:
+                self._on_down(host)
+            return
+
+        self._lock.acquire()
+        try:
+            st = self._stats[host]
+            st['rtt'] = self._average(st['rtt'], rtt)
+            st['up'] = True
+            st['failures'] = 0
+            st['checked'] = time.time()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            for host in self.hosts:
+                if self._stop.isSet():
+                    break
+                self._check(host)
+            self._stop.wait(self.interval)
+            if self._stop.isSet():
+                break
+        for conn in self._conns.values():
+            conn.close()
+
+    def stats(self):
+        """Return a list of dicts with the state of every host."""
+        self._lock.acquire()
+        try:
+            rv = []
+            for host in self.hosts:
+                st = dict(self._stats[host])
+                st['host'], st['port'] = host
+                rv.append(st)
+            return rv
+        finally:
+            self._lock.release()
 
 
 class AbstractConnectionPool(object):
@@ -31,10 +186,33 @@ class AbstractConnectionPool(object):
 
         New 'minconn' connections are created immediately calling 'connfunc'
         with given parameters. The connection pool will support a maximum of
-        about 'maxconn' connections.
+        about 'maxconn' connections. Up to 'maxidle' connections put away are
+        kept open for reuse (by default 'minconn'), the others are closed.
+        If the 'lazy' keyword argument is true the 'minconn' connections are
+        not created.
+
+        The connections older than 'max_age' seconds (if not 0) are closed
+        when put away.
+
+        If the 'hosts' keyword argument is a list of (host, port) pairs,
+        the connection string (the only positional argument) is completed
+        with one of them: the connections are opened to the fastest host
+        answering, moving on to the next one if a host fails.
+
+        If the 'breaker_threshold' keyword argument is given, after that
+        many consecutive failures to connect the pool stops trying and fails
+        at once with PoolError for 'breaker_cooldown' seconds, then lets a
+        single connection attempt through to probe the database again.
         """
         self.minconn = minconn
         self.maxconn = maxconn
+        self.maxidle = kwargs.pop('maxidle', minconn)
+        hosts = kwargs.pop('hosts', ())
+        lazy = kwargs.pop('lazy', False)
+        self.max_age = kwargs.pop('max_age', 0)
+        self.breaker_threshold = kwargs.pop('breaker_threshold', 0)
+        self.breaker_cooldown = kwargs.pop('breaker_cooldown',
+                                           POOL_BREAKER_COOLDOWN)
         self.closed = False
 
         self._args = args
@@ -43,14 +221,144 @@ class AbstractConnectionPool(object):
         self._pool = []
         self._used = {}
         self._rused = {}  # id(conn) -> key map
+        self._state = {}  # id(conn) -> per-connection state
         self._keys = 0
+        self._counters = {'created': 0, 'closed': 0,
+                          'checkouts': 0, 'exhausted': 0,
+                          'reaped': 0, 'expired': 0, 'invalid': 0,
+                          'connect_errors': 0, 'trips': 0, 'rejected': 0}
+
+        # circuit breaker: consecutive connection failures, time it opened
+        # (None if closed), whether a probe connection is in progress
+        self._breaker_lock = threading.Lock()
+        self._failures = 0
+        self._tripped = None
+        self._probing = False
+
+        self._monitor = None
+        if hosts:
+            self._monitor = HostMonitor(hosts, self._connect_host,
+                                        on_down=self.host_down)
+
+        if not lazy:
+            for i in range(self.minconn):
+                self._connect()
+
+        if self._monitor is not None:
+            self._monitor.start()
+
+    def _connect_host(self, host):
+        """Open a connection to one of the pool hosts."""
+        host, port = host
+        dsn = '%s host=%s' % (self._args[0], host)
+        if port:
+            dsn += ' port=%d' % port
+        if 'connect_timeout' not in dsn:
+            # don't wait too long before trying the next host
+            dsn += ' connect_timeout=%d' % HOSTS_CONNECT_TIMEOUT
+        return psycopg2.connect(dsn, **self._kwargs)
+
+    def _open(self):
+        """Open a new connection, return it and its host (None if unknown).
+
+        Use no pool data, so it can be called without holding the lock.
+        Raise PoolError without connecting if the circuit breaker is open.
+        """
+        self._admit()
+        try:
+            rv = self._open_host()
+        except:
+            self._attempted(False)
+            raise
+        self._attempted(True)
+        return rv
+
+    def _open_host(self):
+        """Open a new connection to the best host available."""
+        if self._monitor is None:
+            return psycopg2.connect(*self._args, **self._kwargs), None
+        for host in self._monitor.order():
+            start = time.time()
+            try:
+                conn = self._connect_host(host)
+            except psycopg2.OperationalError:
+                if self._monitor.failed(host):
+                    self.host_down(host)
+                error = sys.exc_info()
+            else:
+                self._monitor.connected(host, time.time() - start)
+                return conn, host
+        raise error[0], error[1], error[2]
+
+    def _admit(self):
+        """Raise PoolError if no connection should be attempted now."""
+        if not self.breaker_threshold:
+            return
+        self._breaker_lock.acquire()
+        try:
+            if self._tripped is None:
+                return
+            if not self._probing and \
+                    time.time() - self._tripped >= self.breaker_cooldown:
+                # let this one through to find out if the database is back
+                self._probing = True
+                return
+            self._counters['rejected'] += 1
+        finally:
+            self._breaker_lock.release()
+        raise PoolError("database unavailable: connection attempts "
+                        "suspended after %d failures" % self._failures)
 
-        for i in range(self.minconn):
-            self._connect()
+    def _attempted(self, ok):
+        """Update the circuit breaker after an attempt to connect."""
+        self._breaker_lock.acquire()
+        try:
+            probing, self._probing = self._probing, False
+            if ok:
+                if self._tripped is not None:
+                    logger.info("database available again, connecting")
+                self._failures = 0
+                self._tripped = None
+                return
+            self._counters['connect_errors'] += 1
+            self._failures += 1
+            if not self.breaker_threshold:
+                return
+            if probing or self._tripped is None and \
+                    self._failures >= self.breaker_threshold:
+                if self._tripped is None:
+                    self._counters['trips'] += 1
+                    logger.warning(
+                        "%d consecutive connection failures: not connecting "
+                        "for %s seconds", self._failures,
+                        self.breaker_cooldown)
+                self._tripped = time.time()
+        finally:
+            self._breaker_lock.release()
+
+    def breaker(self):
+        """Return the state of the circuit breaker.
+
+        'closed' if connecting normally, 'open' if failing without trying,
+        'half-open' if a probe connection is in progress.
+        """
+        if self._tripped is None:
+            return 'closed'
+        if self._probing:
+            return 'half-open'
+        return 'open'
 
     def _connect(self, key=None):
         """Create a new connection and assign it to 'key' if not None."""
-        conn = psycopg2.connect(*self._args, **self._kwargs)
+        conn, host = self._open()
+        return self._add(conn, host, key)
+
+    def _add(self, conn, host, key=None):
+        """Add a new connection and assign it to 'key' if not None."""
+        self._counters['created'] += 1
+        now = time.time()
+        self._state[id(conn)] = {'host': host, 'created': now,
+                                 'last_used': now}
         if key is not None:
             self._used[key] = conn
             self._rused[id(conn)] = key
@@ -92,10 +400,17 @@ class AbstractConnectionPool(object):
         if not key:
             raise PoolError("trying to put unkeyed connection")
 
-        if len(self._pool) < self.minconn and not close:
+        state = self._state.get(id(conn), {})
+        now = time.time()
+        if not close and self.max_age and \
+                now - state.get('created', now) > self.max_age:
+            self._counters['expired'] += 1
+            close = True
+        if len(self._pool) < self.maxidle and not close:
+            state['last_used'] = now
             self._pool.append(conn)
         else:
-            conn.close()
+            self._close(conn)
 
         # here we check for the presence of key because it can happen that a
         # thread tries to put back a connection after a call to close
@@ -103,6 +418,32 @@ class AbstractConnectionPool(object):
             del self._used[key]
             del self._rused[id(conn)]
 
+    def _close(self, conn):
+        """Close a connection and forget its state."""
+        self._state.pop(id(conn), None)
+        self._counters['closed'] += 1
+        conn.close()
+
+    def _host_down(self, host):
+        """Close the idle connections to a host not answering."""
+        pool = []
+        for conn in self._pool:
+            if self._state.get(id(conn), {}).get('host') == host:
+                self._close(conn)
+            else:
+                pool.append(conn)
+        self._pool = pool
+
+    host_down = _host_down
+
+    def _connstate(self, conn):
+        """Return the state dict associated to a connection of the pool.
+
+        The dict can be used to store information about the connection and
+        is discarded when the connection is closed by the pool.
+        """
+        return self._state.setdefault(id(conn), {})
+
     def _closeall(self):
         """Close all connections.
 
@@ -112,11 +453,15 @@ class AbstractConnectionPool(object):
         """
         if self.closed:
             raise PoolError("connection pool is closed")
+        if self._monitor is not None:
+            self._monitor.stop()
         for conn in self._pool + list(self._used.values()):
             try:
                 conn.close()
             except:
                 pass
+            self._counters['closed'] += 1
+        self._state.clear()
         self.closed = True
 
 
@@ -131,26 +476,280 @@ class PersistentConnectionPool(AbstractConnectionPool):
     """
 
     def __init__(self, minconn, maxconn, *args, **kwargs):
-        """Initialize the threading lock."""
+        """Initialize the threading lock.
+
+        If the 'timeout' keyword argument is given, a thread asking for a
+        connection when the pool is exhausted will wait up to 'timeout'
+        seconds for another thread to put one away before failing.
+
+        If the 'lazy' keyword argument is true the 'minconn' connections are
+        created by a background thread, while the pool is already usable.
+
+        If one of the 'idle_timeout', 'max_age' or 'min_ready' keyword
+        arguments is given a maintainer thread periodically closes the
+        connections unused for more than 'idle_timeout' seconds or older than
+        'max_age' seconds, and opens new connections to keep at least
+        'min_ready' of them ready for use.
+
+        The idle connections are checked before being handed out according
+        to the 'validate' keyword argument: 'never', 'status' (check the
+        connection state, without talking to the server) or 'ping' (also run
+        a query on the connections unused for more than 'ping_after'
+        seconds). The connections found broken are replaced.
+        """
         import threading
+        self.timeout = kwargs.pop('timeout', 0)
+        self.validate = kwargs.pop('validate', 'never')
+        self.ping_after = kwargs.pop('ping_after', POOL_PING_AFTER)
+        if self.validate not in ('never', 'status', 'ping'):
+            raise ValueError("bad validate value: %s" % self.validate)
+        self.idle_timeout = kwargs.pop('idle_timeout', 0)
+        self.min_ready = kwargs.pop('min_ready', 0)
+        self.maintain_interval = POOL_MAINTAIN_INTERVAL
+        self._closing = threading.Event()
+        # reentrant: connecting can close the connections to a host down
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._waiters = deque()
+        self._waits = [0] * (len(WAIT_BUCKETS) + 1)
+        self._since = {}  # key -> checkout time
+        self._connecting = 0  # connections being opened for a thread
         AbstractConnectionPool.__init__(
             self, minconn, maxconn, *args, **kwargs)
-        self._lock = threading.Lock()
 
         # we we'll need the thread module, to determine thread ids, so we
         # import it here and copy it in an instance variable
         import thread
         self.__thread = thread
 
+        if kwargs.get('lazy'):
+            self._start(self._warmup, 'ZPsycopgDA pool warm-up')
+        if self.idle_timeout or self.max_age or self.min_ready:
+            self._start(self._maintainer, 'ZPsycopgDA pool maintainer')
+
+    def _start(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.setDaemon(True)
+        t.start()
+
+    def _warmup(self):
+        """Open connections until the pool has 'minconn' of them."""
+        self._fill(lambda: len(self._pool) + len(self._used) < self.minconn)
+
+    def _maintainer(self):
+        """Close the connections unused or too old, replace them if needed."""
+        while True:
+            self._closing.wait(self.maintain_interval)
+            if self._closing.isSet():
+                return
+            self._lock.acquire()
+            try:
+                self._maintain()
+            finally:
+                self._lock.release()
+            self._fill(lambda: len(self._pool) < self.min_ready and
+                       len(self._pool) + len(self._used) < self.maxconn)
+
+    def _maintain(self):
+        """Close the idle connections unused or too old.
+
+        The connections unused for too long are closed only in excess of
+        'min_ready'. Must be called with the lock held.
+        """
+        now = time.time()
+        pool = []
+        for conn in self._pool:
+            state = self._state.get(id(conn), {})
+            if self.max_age and \
+                    now - state.get('created', now) > self.max_age:
+                self._counters['expired'] += 1
+                self._close(conn)
+            else:
+                pool.append(conn)
+
+        # the pool is a stack: the connections unused for longer come first
+        excess = len(pool) - self.min_ready
+        self._pool = []
+        for conn in pool:
+            state = self._state.get(id(conn), {})
+            if excess > 0 and self.idle_timeout and \
+                    now - state.get('last_used', now) > self.idle_timeout:
+                self._counters['reaped'] += 1
+                self._close(conn)
+                excess -= 1
+            else:
+                self._pool.append(conn)
+
+    def _fill(self, needed):
+        """Open connections while 'needed()' returns True.
+
+        The connections are opened without holding the lock, so the threads
+        using the pool in the meantime are not blocked.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                if self.closed or not needed():
+                    return
+            finally:
+                self._lock.release()
+
+            try:
+                conn, host = self._open()
+            except psycopg2.Error, e:
+                logger.warning("cannot open a pool connection: %s", e)
+                return
+
+            self._lock.acquire()
+            try:
+                if self.closed:
+                    conn.close()
+                    return
+                self._add(conn, host)
+                if self._waiters:
+                    self._cond.notify_all()
+            finally:
+                self._lock.release()
+
     def getconn(self):
         """Generate thread id and return a connection."""
         key = self.__thread.get_ident()
+        start = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                if key in self._used:
+                    return self._used[key]
+                if self._waiters or self._exhausted():
+                    self._wait(key)
+                if self.closed:
+                    raise PoolError("connection pool is closed")
+                if not self._pool:
+                    # keep the slot while connecting
+                    self._connecting += 1
+                    conn = None
+                else:
+                    conn = self._getconn(key)
+                    if self.validate == 'never':
+                        self._checkout(key, start)
+                        return conn
+                    state = self._connstate(conn)
+            finally:
+                self._lock.release()
+
+            if conn is None:
+                return self._open_for(key, start)
+
+            # don't block the other threads while checking the connection
+            valid = self._valid(conn, state)
+
+            self._lock.acquire()
+            try:
+                if valid:
+                    self._checkout(key, start)
+                    return conn
+                self._counters['invalid'] += 1
+                self._putconn(conn, key, close=True)
+                if self._waiters:
+                    self._cond.notify_all()
+            finally:
+                self._lock.release()
+
+    def _open_for(self, key, start):
+        """Open a new connection for 'key', in a slot already reserved.
+
+        The connection is opened without holding the lock, so the other
+        threads are not blocked if the database is slow to answer.
+        """
+        try:
+            conn, host = self._open()
+        except:
+            self._lock.acquire()
+            try:
+                self._connecting -= 1
+                if self._waiters:
+                    self._cond.notify_all()
+            finally:
+                self._lock.release()
+            raise
+
         self._lock.acquire()
         try:
-            return self._getconn(key)
+            self._connecting -= 1
+            if self.closed:
+                conn.close()
+                raise PoolError("connection pool is closed")
+            self._add(conn, host, key)
+            self._checkout(key, start)
+            return conn
         finally:
             self._lock.release()
 
+    def _valid(self, conn, state):
+        """Return False if an idle connection is found broken."""
+        if conn.closed:
+            return False
+        try:
+            if conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+                return False
+            if self.validate == 'ping' and \
+                    time.time() - state.get('last_used', 0) > self.ping_after:
+                curs = conn.cursor()
+                curs.execute("SELECT 1")
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @property
+    def waiting(self):
+        """Number of threads waiting for a connection."""
+        return len(self._waiters)
+
+    def _exhausted(self):
+        """Return True if no connection can be handed out right now."""
+        return not self._pool and \
+            len(self._used) + self._connecting >= self.maxconn
+
+    def _checkout(self, key, start):
+        """Record the checkout of a connection requested at 'start'."""
+        now = time.time()
+        self._since[key] = now
+        self._counters['checkouts'] += 1
+        wait = now - start
+        for i, limit in enumerate(WAIT_BUCKETS):
+            if wait < limit:
+                break
+        else:
+            i = len(WAIT_BUCKETS)
+        self._waits[i] += 1
+
+    def _wait(self, key):
+        """Wait in line until a connection can be handed out to 'key'.
+
+        Threads are served in the order they started waiting. Must be called
+        with the lock held.
+        """
+        if not self.timeout:
+            self._counters['exhausted'] += 1
+            raise PoolError("connection pool exausted")
+
+        deadline = time.time() + self.timeout
+        self._waiters.append(key)
+        try:
+            while self._waiters[0] != key or self._exhausted():
+                if self.closed:
+                    return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._counters['exhausted'] += 1
+                    raise PoolError("connection pool exausted")
+                self._cond.wait(remaining)
+        finally:
+            self._waiters.remove(key)
+            # let the next thread in line check for its turn
+            self._cond.notify_all()
+
     def putconn(self, conn=None, close=False):
         """Put away an unused connection."""
         key = self.__thread.get_ident()
@@ -159,6 +758,59 @@ class PersistentConnectionPool(AbstractConnectionPool):
             if not conn:
                 conn = self._used[key]
             self._putconn(conn, key, close)
+            self._since.pop(key, None)
+            if self._waiters:
+                self._cond.notify_all()
+        finally:
+            self._lock.release()
+
+    def host_down(self, host):
+        """Close the idle connections to a host not answering."""
+        self._lock.acquire()
+        try:
+            self._host_down(host)
+        finally:
+            self._lock.release()
+
+    def connstate(self, conn):
+        """Return the state dict associated to a connection of the pool."""
+        self._lock.acquire()
+        try:
+            return self._connstate(conn)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a dict with the pool settings, counters and gauges.
+
+        'wait_histogram' is a list of (limit, count) pairs counting the
+        checkouts that took less than 'limit' seconds (None for the slower
+        ones), 'holders' a list of (thread id, seconds) pairs for the threads
+        holding a connection, 'hosts' the state of the hosts if the pool
+        has more than one (see HostMonitor.stats()), 'breaker' the state of
+        the circuit breaker (see breaker()) and 'failures' the number of
+        consecutive failures to connect.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            rv = dict(self._counters)
+            rv.update(
+                minconn=self.minconn, maxidle=self.maxidle,
+                maxconn=self.maxconn, timeout=self.timeout,
+                idle_timeout=self.idle_timeout, max_age=self.max_age,
+                min_ready=self.min_ready, validate=self.validate,
+                ping_after=self.ping_after,
+                breaker_threshold=self.breaker_threshold,
+                breaker_cooldown=self.breaker_cooldown,
+                breaker=self.breaker(), failures=self._failures,
+                in_use=len(self._used), idle=len(self._pool),
+                connecting=self._connecting,
+                waiting=len(self._waiters),
+                wait_histogram=zip(WAIT_BUCKETS + (None,), self._waits),
+                holders=sorted((k, now - t) for k, t in self._since.items()),
+                hosts=self._monitor and self._monitor.stats() or [])
+            return rv
         finally:
             self._lock.release()
 
@@ -166,21 +818,64 @@ class PersistentConnectionPool(AbstractConnectionPool):
         """Close all connections (even the one currently in use.)"""
         self._lock.acquire()
         try:
+            self._closing.set()
             self._closeall()
+            self._since.clear()
+            self._cond.notify_all()
         finally:
             self._lock.release()
 
 
+# upper limits (in seconds) of the checkout time histogram buckets
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+# default pool settings: connections opened when the pool is created,
+# connections kept open when put away, hard limit of open connections and
+# seconds a thread waits for a connection when the pool is exhausted
+POOL_MINCONN = 4
+POOL_MAXIDLE = 16
+POOL_MAXCONN = 200
+POOL_TIMEOUT = 5
+
+# seconds between the runs of the pool maintainer thread
+POOL_MAINTAIN_INTERVAL = 10
+
+# default check of the idle connections handed out and seconds of idleness
+# after which the 'ping' check queries the server
+POOL_VALIDATE = 'status'
+POOL_PING_AFTER = 30
+
+# consecutive connection failures after which a pool stops connecting and
+# seconds before trying again (0 failures disables the circuit breaker)
+POOL_BREAKER_THRESHOLD = 5
+POOL_BREAKER_COOLDOWN = 10
+
+# seconds between the checks of the hosts of a multi-host pool, weight of
+# the last measure in the latency averages, connection timeout of a host
+HOSTS_CHECK_INTERVAL = 5
+HOSTS_EWMA_WEIGHT = 0.3
+HOSTS_CONNECT_TIMEOUT = 2
+
 _connections_pool = {}
 _connections_lock = threading.Lock()
 
 
-def getpool(dsn, create=True):
+def getpool(dsn, create=True, minconn=POOL_MINCONN, maxidle=POOL_MAXIDLE,
+            maxconn=POOL_MAXCONN, timeout=POOL_TIMEOUT, hosts=(), lazy=False,
+            idle_timeout=0, max_age=0, min_ready=0, validate=POOL_VALIDATE,
+            ping_after=POOL_PING_AFTER,
+            breaker_threshold=POOL_BREAKER_THRESHOLD,
+            breaker_cooldown=POOL_BREAKER_COOLDOWN):
     _connections_lock.acquire()
     try:
         if dsn not in _connections_pool and create:
-            _connections_pool[dsn] = \
-                PersistentConnectionPool(4, 200, dsn)
+            _connections_pool[dsn] = PersistentConnectionPool(
+                minconn, maxconn, dsn, maxidle=maxidle, timeout=timeout,
+                hosts=map(parse_host, hosts), lazy=lazy,
+                idle_timeout=idle_timeout, max_age=max_age,
+                min_ready=min_ready, validate=validate, ping_after=ping_after,
+                breaker_threshold=breaker_threshold,
+                breaker_cooldown=breaker_cooldown)
     finally:
         _connections_lock.release()
     return _connections_pool[dsn]
@@ -195,8 +890,32 @@ def flushpool(dsn):
         _connections_lock.release()
 
 
-def getconn(dsn, create=True):
-    return getpool(dsn, create=create).getconn()
+def getconn(dsn, create=True, **settings):
+    return getpool(dsn, create=create, **settings).getconn()
+
+
+def getstats(dsn):
+    """Return the stats of the pool for 'dsn', an empty dict if missing."""
+    _connections_lock.acquire()
+    try:
+        p = _connections_pool.get(dsn)
+    finally:
+        _connections_lock.release()
+    if p is None:
+        return {}
+    return p.stats()
+
+
+def inuse(dsn):
+    """Return the number of connections in use from the pool for 'dsn'."""
+    p = _connections_pool.get(dsn)
+    if p is None:
+        return 0
+    return len(p._used)
+
+
+def connstate(dsn, conn):
+    return getpool(dsn, create=False).connstate(conn)
 
 
 def putconn(dsn, conn, close=False):
@@ -29,6 +29,7 @@ from zope.interface import implements
 from zope.rdb import ZopeDatabaseAdapter, parseDSN, ZopeConnection, ZopeCursor
 from zope.rdb.interfaces import DatabaseException, IZopeConnection
 from zope.publisher.interfaces import Retry
+from zope.datetime import tzinfo
 
 from datetime import date, time, datetime, timedelta
 
@@ -50,6 +51,79 @@ BPCHAR_OID      = 1042
 VARCHAR_OID     = 1043
 
 # date/time parsing functions
+
+# PostgreSQL with DateStyle=ISO always returns the same layout, e.g.
+# '2006-01-02 03:04:05.678+01': the _iso_* functions parse it by slicing and
+# return None for any other string, which goes through the regular
+# expressions. They accept exactly the strings the regexps would accept.
+
+def _two_digits(n):
+    return dict(('%02d' % i, i) for i in xrange(n))
+
+# values of the two digits fields, by the range allowed by the regexps
+_d100 = _two_digits(100)    # \d\d
+_d60 = _two_digits(60)      # [0-5]\d
+_d40 = _two_digits(40)      # [0-3]\d
+_d30 = _two_digits(30)      # [0-2]\d
+_d20 = _two_digits(20)      # [01]\d
+
+def _iso_date(s):
+    """Parse 'YYYY-MM-DD', or return None."""
+    if type(s) is str and len(s) == 10 and s[4] == '-' and s[7] == '-':
+        try:
+            return (_d100[s[:2]] * 100 + _d100[s[2:4]],
+                    _d20[s[5:7]], _d40[s[8:]])
+        except KeyError:
+            return None
+
+
+def _iso_time(s):
+    """Parse 'HH:MM:SS' or 'HH:MM:SS.ssssss', or return None."""
+    if type(s) is str and len(s) >= 8 and s[2] == ':' and s[5] == ':':
+        try:
+            hr, mn, sc = _d30[s[:2]], _d60[s[3:5]], _d60[s[6:8]]
+        except KeyError:
+            return None
+        if len(s) == 8:
+            return hr, mn, sc
+        if s[8] == '.' and len(s) > 9 and not s[9:].lstrip('0123456789'):
+            return hr, mn, float(s[6:])
+
+
+def _iso_tz(s):
+    """Parse '+HH' or '+HH:MM', or return None."""
+    try:
+        if len(s) == 3:
+            tz = _d30[s[1:]] * 60
+        elif len(s) == 6 and s[3] == ':':
+            tz = _d30[s[1:3]] * 60 + _d60[s[4:]]
+        else:
+            return None
+    except KeyError:
+        return None
+    if s[0] == '-':
+        return -tz
+    return tz
+
+
+def _iso_timetz(s):
+    """Parse an ISO time with optional time zone, or return None."""
+    if type(s) is str:
+        pos = s.find('+', 8)
+        if pos < 0:
+            pos = s.find('-', 8)
+            if pos < 0:
+                t = _iso_time(s)
+                if t is not None:
+                    return t + (None,)
+                return None
+        t = _iso_time(s[:pos])
+        if t is not None:
+            tz = _iso_tz(s[pos:])
+            if tz is not None:
+                return t + (tz,)
+
+
 _dateFmt = re.compile(r"^(\d\d\d\d)-?([01]\d)-?([0-3]\d)$")
 
 def parse_date(s):
@@ -60,6 +134,11 @@ def parse_date(s):
         YYYY-MM-DD  (extended format)
         YYYYMMDD    (basic format)
     """
+    return _iso_date(s) or _parse_date_re(s)
+
+
+def _parse_date_re(s):
+    """Parse a date using the regular expression."""
     m = _dateFmt.match(s)
     if m is None:
         raise ValueError, 'invalid date string: %s' % s
@@ -81,6 +160,11 @@ def parse_time(s):
         HH:MM         or HHMM
         HH
     """
+    return _iso_time(s) or _parse_time_re(s)
+
+
+def _parse_time_re(s):
+    """Parse a time using the regular expression."""
     m = _timeFmt.match(s)
     if m is None:
         raise ValueError, 'invalid time string: %s' % s
@@ -128,11 +212,16 @@ def parse_timetz(s):
     parse_tz().  Time zone should immediatelly follow time without intervening
     spaces.
     """
+    return _iso_timetz(s) or _parse_timetz_re(s)
+
+
+def _parse_timetz_re(s):
+    """Parse a time with time zone using the regular expressions."""
     m = _tzPos.search(s)
     if m is None:
-        return parse_time(s) + (None,)
+        return _parse_time_re(s) + (None,)
     pos = m.start()
-    return parse_time(s[:pos]) + (parse_tz(s[pos:]),)
+    return _parse_time_re(s[:pos]) + (parse_tz(s[pos:]),)
 
 
 _datetimeFmt = re.compile(r"[T ]")
@@ -157,8 +246,19 @@ def parse_datetime(s):
     Formats accepted are those listed in the descriptions of parse_date() and
     parse_time() with ' ' or 'T' used to separate date and time parts.
     """
+    if type(s) is str and len(s) >= 19 and s[10] == ' ':
+        dt = _iso_date(s[:10])
+        if dt is not None:
+            tm = _iso_time(s[11:])
+            if tm is not None:
+                return dt + tm
+    return _parse_datetime_re(s)
+
+
+def _parse_datetime_re(s):
+    """Parse a timestamp using the regular expressions."""
     dt, tm = _split_datetime(s)
-    return parse_date(dt) + parse_time(tm)
+    return _parse_date_re(dt) + _parse_time_re(tm)
 
 
 def parse_datetimetz(s):
@@ -172,8 +272,19 @@ def parse_datetimetz(s):
     Formats accepted are those listed in the descriptions of parse_date() and
     parse_timetz() with ' ' or 'T' used to separate date and time parts.
     """
+    if type(s) is str and len(s) >= 19 and s[10] == ' ':
+        dt = _iso_date(s[:10])
+        if dt is not None:
+            tm = _iso_timetz(s[11:])
+            if tm is not None:
+                return dt + tm
+    return _parse_datetimetz_re(s)
+
+
+def _parse_datetimetz_re(s):
+    """Parse a timestamp with time zone using the regular expressions."""
     dt, tm = _split_datetime(s)
-    return parse_date(dt) + parse_timetz(tm)
+    return _parse_date_re(dt) + _parse_timetz_re(tm)
 
 
 def parse_interval(s):
@@ -244,7 +355,6 @@ def _conv_time(s, cursor):
 
 def _conv_timetz(s, cursor):
     if s:
-        from zope.datetime import tzinfo
         hr, mn, sc, tz = parse_timetz(s)
         sc, micro = divmod(sc, 1.0)
         micro = round(micro * 1000000)
@@ -260,7 +370,6 @@ def _conv_timestamp(s, cursor):
 
 def _conv_timestamptz(s, cursor):
     if s:
-        from zope.datetime import tzinfo
         y, m, d, hr, mn, sc, tz = parse_datetimetz(s)
         sc, micro = divmod(sc, 1.0)
         micro = round(micro * 1000000)
@@ -360,6 +469,143 @@ class Psycopg2Adapter(ZopeDatabaseAdapter):
             self._v_connection = None
 
 
+_valuesFmt = re.compile(r"^(.*\bVALUES\s*)(\(.*\))(\s*)$",
+                        re.IGNORECASE | re.DOTALL)
+
+def _single_group(s):
+    """Return True if s is a single parenthesized group, such as '(a, f(b))'.
+    """
+    depth = 0
+    quote = None
+    for i, c in enumerate(s):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0 and i < len(s) - 1:
+                return False
+    return depth == 0 and not quote
+
+
+def batch_operations(operation, seq_of_parameters, mogrify, page_size,
+                     encoding='utf-8'):
+    """Generate the statements to execute operation with many parameters.
+
+    Every statement merges up to page_size parameter sets, bound by the
+    mogrify function: if operation ends with a VALUES clause, such as in
+    'INSERT INTO t (a, b) VALUES (%s, %s)', into a single multi-row VALUES
+    clause, else into a sequence of statements separated by semicolons.
+    A unicode operation is encoded with encoding, as mogrify returns bytes.
+    """
+    if isinstance(operation, unicode):
+        operation = operation.encode(encoding)
+    m = _valuesFmt.match(operation)
+    if m is not None and _single_group(m.group(2)) \
+            and '%' not in m.group(1) + m.group(3):
+        head, template, tail = m.groups()
+        join = lambda page: head + ','.join(page) + tail
+    else:
+        template = operation
+        join = ';'.join
+
+    page = []
+    for parameters in seq_of_parameters:
+        page.append(mogrify(template, parameters))
+        if len(page) >= page_size:
+            yield join(page)
+            page = []
+    if page:
+        yield join(page)
+
+
+def _copy_value(value, encoding, format='text'):
+    """Format a value for COPY in 'text' or 'csv' format."""
+    if value is None:
+        return format == 'text' and '\\N' or ''
+    if isinstance(value, unicode):
+        value = value.encode(encoding)
+    elif isinstance(value, float):
+        # str() keeps only 12 significant digits
+        value = repr(value)
+    else:
+        value = str(value)
+    if format == 'csv':
+        return '"%s"' % value.replace('"', '""')
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _quote_ident(name):
+    """Quote a possibly schema-qualified identifier, unless already quoted."""
+    if '"' in name:
+        return name
+    return '.'.join(['"%s"' % part for part in name.split('.')])
+
+
+# queries, as opposed to table names, passed to copy_out()
+_copyQuery = re.compile(r'\s*(select|values|with)\b', re.IGNORECASE)
+
+
+class CopyReader(object):
+    """File-like object reading an iterable of records in COPY format.
+
+    format can be 'text' or 'csv'.
+    """
+
+    def __init__(self, rows, encoding, format='text'):
+        if format not in ('text', 'csv'):
+            raise ValueError("bad COPY format: %s" % format)
+        self.encoding = encoding
+        self.format = format
+        self._rows = iter(rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        lines = [self._buffer]
+        length = len(self._buffer)
+        sep = self.format == 'text' and '\t' or ','
+        for row in self._rows:
+            line = sep.join([_copy_value(v, self.encoding, self.format)
+                             for v in row])
+            lines.append(line + '\n')
+            length += len(line) + 1
+            if 0 <= size <= length:
+                break
+        data = ''.join(lines)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class CopyWriter(object):
+    """File-like object passing data to writable in chunks of size bytes."""
+
+    def __init__(self, writable, size):
+        self.writable = writable
+        self.size = size
+        self._buffer = []
+        self._length = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._length += len(data)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.writable.write(''.join(self._buffer))
+            self._buffer = []
+            self._length = 0
+
+
 def _handle_psycopg_exception(error):
     """Called from a exception handler for psycopg2.Error.
 
@@ -389,9 +635,62 @@ class Psycopg2Connection(ZopeConnection):
         except psycopg2.Error, error:
             _handle_psycopg_exception(error)
 
+    # size of the chunks of data exchanged by copy_in() and copy_out()
+    copy_size = 64 * 1024
+
+    def copy_in(self, table, rows, columns=None, format='text', size=None):
+        """Load the records of the rows iterable into table using COPY.
+
+        columns is the list of the columns of the records, if not all the
+        table columns. The records are sent to the server in chunks of size
+        bytes (copy_size by default) in 'text' or 'csv' format.
+        """
+        sql = 'COPY %s' % _quote_ident(table)
+        if columns:
+            sql += ' (%s)' % ', '.join(map(_quote_ident, columns))
+        sql += ' FROM STDIN'
+        if format == 'csv':
+            sql += ' CSV'
+        reader = CopyReader(rows, self.getTypeInfo().getEncoding(), format)
+        self.registerForTxn()
+        try:
+            self.conn.cursor().copy_expert(sql, reader,
+                                           size or self.copy_size)
+        except psycopg2.Error, error:
+            _handle_psycopg_exception(error)
+
+    def copy_out(self, query, writable, format='text', header=False,
+                 size=None):
+        """Write the result of query to writable using COPY.
+
+        query is a SELECT or a table name. The data, in 'text' or 'csv'
+        format (with a header line if header is true), is passed to
+        writable.write() in chunks of about size bytes (copy_size by
+        default) as it is received from the server.
+        """
+        if format not in ('text', 'csv'):
+            raise ValueError("bad COPY format: %s" % format)
+        if _copyQuery.match(query):
+            sql = 'COPY (%s) TO STDOUT' % query
+        else:
+            sql = 'COPY %s TO STDOUT' % _quote_ident(query)
+        if format == 'csv':
+            sql += header and ' CSV HEADER' or ' CSV'
+        size = size or self.copy_size
+        writer = CopyWriter(writable, size)
+        self.registerForTxn()
+        try:
+            self.conn.cursor().copy_expert(sql, writer, size)
+            writer.flush()
+        except psycopg2.Error, error:
+            _handle_psycopg_exception(error)
+
 
 class Psycopg2Cursor(ZopeCursor):
 
+    # number of parameter sets sent to the server at once by executemany()
+    executemany_page_size = 100
+
     def execute(self, operation, parameters=None):
         """See IZopeCursor"""
         try:
@@ -399,10 +698,14 @@ class Psycopg2Cursor(ZopeCursor):
         except psycopg2.Error, error:
             _handle_psycopg_exception(error)
 
-    def executemany(operation, seq_of_parameters=None):
+    def executemany(self, operation, seq_of_parameters):
         """See IZopeCursor"""
-        raise RuntimeError, 'Oos'
         try:
-            return ZopeCursor.execute(self, operation, seq_of_parameters)
+            encoding = self.connection.getTypeInfo().getEncoding()
+            for batch in batch_operations(operation, seq_of_parameters,
+                                          self.cursor.mogrify,
+                                          self.executemany_page_size,
+                                          encoding):
+                ZopeCursor.execute(self, batch)
         except psycopg2.Error, error:
             _handle_psycopg_exception(error)
@@ -0,0 +1,58 @@
+# Copyright (C) 2006 Fabio Tranchitella <fabio@tranchitella.it>
+#
+# psycopg2da is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link this program with the OpenSSL library (or with
+# modified versions of OpenSSL that use the same license as OpenSSL),
+# and distribute linked combinations including the two.
+#
+# You must obey the GNU Lesser General Public License in all respects for
+# all of the code used other than OpenSSL.
+#
+# psycopg2da is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
+# License for more details.
+#
+# If you prefer you can use this package using the ZPL license as
+# published on the Zope web site, http://www.zope.org/Resources/ZPL.
+
+"""Micro-benchmark of the date/time parsing functions.
+
+Compare the parsers of the PostgreSQL ISO output with the regular
+expressions used for the other strings. Run as:
+
+    python -m psycopg2da.benchmark [number]
+"""
+
+import sys
+import timeit
+
+SAMPLES = (
+    ('date', '2006-01-02'),
+    ('time', '03:04:05.678901'),
+    ('timetz', '03:04:05.678901+01'),
+    ('datetime', '2006-01-02 03:04:05.678901'),
+    ('datetimetz', '2006-01-02 03:04:05.678901+05:30'),
+    )
+
+
+def main(number=100000):
+    print "%-12s %12s %12s %8s" % ('function', 'regexp (us)', 'fast (us)',
+                                   'speedup')
+    for name, s in SAMPLES:
+        times = []
+        for func in ('_parse_%s_re' % name, 'parse_' + name):
+            timer = timeit.Timer('parse(%r)' % s,
+                'from psycopg2da.adapter import %s as parse' % func)
+            times.append(min(timer.repeat(3, number)) / number * 1e6)
+        print "%-12s %12.2f %12.2f %7.1fx" % (
+            name, times[0], times[1], times[0] / times[1])
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -194,6 +194,156 @@ class TestPsycopg2TypeConversion(TestCase):
         self.assertEquals(c('\xc3\x82\xc2\xa2'), u'\xc2\xa2')
         self.assertEquals(c('c\xc3\x82\xc2\xa2'), u'c\xc2\xa2')
 
+    def test_conv_tzinfo_shared(self):
+        from psycopg2da.adapter import _conv_timetz, _conv_timestamptz
+        t1 = _conv_timetz('12:44:01+01', None)
+        t2 = _conv_timetz('13:44:01.5+01:00', None)
+        d1 = _conv_timestamptz('2001-03-02 12:44:01+01', None)
+        d2 = _conv_timestamptz('2001-03-04T12:44:01+0100', None)
+        self.assert_(t1.tzinfo is t2.tzinfo)
+        self.assert_(d1.tzinfo is d2.tzinfo)
+        self.assert_(t1.tzinfo is d1.tzinfo)
+        d3 = _conv_timestamptz('2001-03-02 12:44:01-01', None)
+        self.assert_(d3.tzinfo is not d1.tzinfo)
+
+
+class TestBatchOperations(TestCase):
+
+    def mogrify(self, operation, parameters):
+        return operation % tuple(map(repr, parameters))
+
+    def batches(self, operation, seq_of_parameters, page_size=2):
+        from psycopg2da.adapter import batch_operations
+        return list(batch_operations(operation, seq_of_parameters,
+                                     self.mogrify, page_size))
+
+    def test_values(self):
+        self.assertEquals(
+            self.batches("INSERT INTO t (a, b) VALUES (%s, lower(%s))",
+                         [(1, 'a'), (2, 'b'), (3, 'c')]),
+            ["INSERT INTO t (a, b) VALUES (1, lower('a')),(2, lower('b'))",
+             "INSERT INTO t (a, b) VALUES (3, lower('c'))"])
+
+    def test_statements(self):
+        self.assertEquals(
+            self.batches("UPDATE t SET b = %s WHERE a = %s",
+                         [('a', 1), ('b', 2), ('c', 3)]),
+            ["UPDATE t SET b = 'a' WHERE a = 1;UPDATE t SET b = 'b' WHERE a = 2",
+             "UPDATE t SET b = 'c' WHERE a = 3"])
+
+    def test_values_not_last(self):
+        self.assertEquals(
+            self.batches("INSERT INTO t VALUES (%s) ON CONFLICT (a) "
+                         "DO UPDATE SET b = lower(b)", [(1,), (2,)]),
+            ["INSERT INTO t VALUES (1) ON CONFLICT (a) "
+             "DO UPDATE SET b = lower(b);"
+             "INSERT INTO t VALUES (2) ON CONFLICT (a) "
+             "DO UPDATE SET b = lower(b)"])
+
+    def test_values_parens_in_string(self):
+        self.assertEquals(
+            self.batches("INSERT INTO t VALUES (%s, ')(')", [(1,), (2,)]),
+            ["INSERT INTO t VALUES (1, ')('),(2, ')(')"])
+
+    def test_empty(self):
+        self.assertEquals(self.batches("INSERT INTO t VALUES (%s)", []), [])
+
+    def test_unicode(self):
+        # mogrify returns the parameters encoded
+        self.assertEquals(
+            self.batches(u"INSERT INTO t VALUES (%s, '\xe8')",
+                         [('\xc3\xa0',), ('b',)]),
+            ["INSERT INTO t VALUES ('\\xc3\\xa0', '\xc3\xa8'),"
+             "('b', '\xc3\xa8')"])
+
+
+class TestCopyReader(TestCase):
+
+    def test_read(self):
+        from psycopg2da.adapter import CopyReader
+        r = CopyReader([(1, None, u'\xe8\ta\\b\n'), ('c', True)], 'utf-8')
+        self.assertEquals(r.read(5), '1\t\\N\t')
+        self.assertEquals(r.read(100),
+                          '\xc3\xa8\\ta\\\\b\\n\nc\tTrue\n')
+        self.assertEquals(r.read(100), '')
+
+    def test_float(self):
+        from psycopg2da.adapter import CopyReader
+        r = CopyReader([(0.1 + 0.2, 1234567.891234567)], 'utf-8')
+        self.assertEquals(map(float, r.read().split('\t')),
+                          [0.1 + 0.2, 1234567.891234567])
+
+    def test_csv(self):
+        from psycopg2da.adapter import CopyReader
+        r = CopyReader([(1, None, u'\xe8,"a"\n')], 'utf-8', 'csv')
+        self.assertEquals(r.read(), '"1",,"\xc3\xa8,""a""\n"\n')
+        self.assertRaises(ValueError, CopyReader, [], 'utf-8', 'binary')
+
+
+class TestCopyWriter(TestCase):
+
+    def test_write(self):
+        from psycopg2da.adapter import CopyWriter
+        writes = []
+        w = CopyWriter(Stub(write=writes.append), 4)
+        for data in ('ab', 'cd', 'e'):
+            w.write(data)
+        w.flush()
+        self.assertEquals(writes, ['abcd', 'e'])
+
+
+class CopyCursorStub(object):
+
+    def __init__(self, log):
+        self.log = log
+
+    def copy_expert(self, sql, file, size):
+        self.log.append(sql)
+        if 'TO STDOUT' in sql:
+            for row in ('1\ta\n', '2\tb\n'):
+                file.write(row)
+        else:
+            file.read()
+
+
+class TestCopy(TestCase):
+
+    def connection(self):
+        from psycopg2da.adapter import Psycopg2Connection
+        conn = Psycopg2Connection.__new__(Psycopg2Connection)
+        self.log = []
+        conn.conn = Stub(cursor=lambda: CopyCursorStub(self.log))
+        conn.registerForTxn = lambda: None
+        conn.getTypeInfo = lambda: Stub(getEncoding=lambda: 'utf-8')
+        return conn
+
+    def test_copy_in_quoted(self):
+        self.connection().copy_in('s.t', [(1, 'a')], ['id', 'data'])
+        self.assertEquals(self.log,
+                          ['COPY "s"."t" ("id", "data") FROM STDIN'])
+
+    def test_copy_in_csv(self):
+        self.connection().copy_in('t', [(1, 'a')], format='csv')
+        self.assertEquals(self.log, ['COPY "t" FROM STDIN CSV'])
+
+    def test_copy_out(self):
+        conn = self.connection()
+        writes = []
+        conn.copy_out('WITH x AS (SELECT 1) SELECT * FROM x',
+                      Stub(write=writes.append))
+        conn.copy_out('t', Stub(write=writes.append), format='csv')
+        conn.copy_out('t', Stub(write=writes.append), format='csv',
+                      header=True)
+        self.assertEquals(self.log,
+                          ['COPY (WITH x AS (SELECT 1) SELECT * FROM x) '
+                           'TO STDOUT',
+                           'COPY "t" TO STDOUT CSV',
+                           'COPY "t" TO STDOUT CSV HEADER'])
+        # the rows are written in a single chunk
+        self.assertEquals(writes, ['1\ta\n2\tb\n'] * 3)
+        self.assertRaises(ValueError, conn.copy_out, 't', None, 'binary')
+
+
 class TestPsycopg2Adapter(TestCase):
 
     def setUp(self):
@@ -384,11 +534,85 @@ class TestISODateTime(TestCase):
             self.assertRaises(self.exception_type, self.parse_datetimetz, s)
 
 
+class TestISODateTimeRegexp(TestISODateTime):
+
+    # The same tests on the regexps used for the strings not in the
+    # PostgreSQL ISO output layout.
+
+    def setUp(self):
+        from psycopg2da.adapter import _parse_date_re, _parse_time_re, \
+            _parse_timetz_re, _parse_datetime_re, _parse_datetimetz_re
+        self.parse_date = _parse_date_re
+        self.parse_time = _parse_time_re
+        self.parse_timetz = _parse_timetz_re
+        self.parse_datetime = _parse_datetime_re
+        self.parse_datetimetz = _parse_datetimetz_re
+
+
+class TestISOFastPath(TestCase):
+
+    # The parsers must return the same results as the regexps, for the
+    # PostgreSQL output and for random variations of it.
+
+    samples = ('2006-01-02 03:04:05.678+01', '2006-12-31 23:59:59-05:30',
+               '1999-01-08 04:05:06', '0001-01-01 00:00:00.000001-00',
+               '03:04:05.5', '23:59:59+01', '2006-01-02')
+
+    noise = '0123456789:-+.,TZ 9\n'
+
+    def parse(self, func, s):
+        try:
+            return func(s)
+        except ValueError:
+            return ValueError
+
+    def variations(self):
+        import random
+        rnd = random.Random(42)
+        for i in xrange(20000):
+            s = list(rnd.choice(self.samples))
+            for j in range(rnd.randint(0, 2)):
+                pos = rnd.randrange(len(s))
+                op = rnd.randrange(3)
+                if op == 0:
+                    s[pos] = rnd.choice(self.noise)
+                elif op == 1:
+                    s.insert(pos, rnd.choice(self.noise))
+                else:
+                    del s[pos]
+            yield ''.join(s)
+
+    def test_same_results(self):
+        import psycopg2da.adapter as adapter
+        for name in ('date', 'time', 'timetz', 'datetime', 'datetimetz'):
+            fast = getattr(adapter, 'parse_' + name)
+            regexp = getattr(adapter, '_parse_%s_re' % name)
+            for s in self.samples + tuple(self.variations()):
+                got = self.parse(fast, s)
+                expected = self.parse(regexp, s)
+                self.assertEqual(got, expected, s)
+                if expected is not ValueError:
+                    self.assertEqual(map(type, got), map(type, expected), s)
+
+    def test_unicode(self):
+        from psycopg2da.adapter import parse_datetimetz
+        self.assertEqual(parse_datetimetz(u'2006-01-02 03:04:05+01'),
+                         (2006, 1, 2, 3, 4, 5, 60))
+        self.assertRaises(ValueError, parse_datetimetz,
+                          u'2006-01-02 03:04:0\u0665+01')
+
+
 def test_suite():
     return TestSuite((
         makeSuite(TestPsycopg2TypeConversion),
+        makeSuite(TestBatchOperations),
+        makeSuite(TestCopyReader),
+        makeSuite(TestCopyWriter),
+        makeSuite(TestCopy),
         makeSuite(TestPsycopg2Adapter),
         makeSuite(TestISODateTime),
+        makeSuite(TestISODateTimeRegexp),
+        makeSuite(TestISOFastPath),
         ))
 
 if __name__=='__main__':
@@ -44,6 +44,12 @@ def test_suite():
     suite.addTest(test_da_threading.test_suite())
     import test_xn_reset
     suite.addTest(test_xn_reset.test_suite())
+    import test_db
+    suite.addTest(test_db.test_suite())
+    import test_pool
+    suite.addTest(test_pool.test_suite())
+    import test_casts
+    suite.addTest(test_casts.test_suite())
 
     return suite
 
@@ -0,0 +1,69 @@
+# test the Zope typecasters
+
+from Products.ZPsycopgDA.DA import DateTimeCache, _cast_Time
+from DateTime import DateTime
+import time
+
+from testutils import unittest
+
+
+class DateTimeCacheTests(unittest.TestCase):
+    def test_same_value(self):
+        cache = DateTimeCache(10)
+        dt = cache('2012-01-02 03:04:05+01')
+        self.assertEqual(dt, DateTime('2012-01-02 03:04:05+01'))
+        self.assert_(cache('2012-01-02 03:04:05+01') is dt)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_bounded(self):
+        cache = DateTimeCache(2)
+        first = cache('2012-01-01')
+        cache('2012-01-02')
+        cache('2012-01-01')
+        cache('2012-01-03')
+        self.assertEqual(cache.stats()['entries'], 2)
+        # the least recently used value is the one dropped
+        self.assert_(cache('2012-01-01') is first)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_resize(self):
+        cache = DateTimeCache(10)
+        for day in range(1, 6):
+            cache('2012-01-0%d' % day)
+        cache.resize(2)
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['entries']), (2, 2))
+        cache.resize(0)
+        cache('2012-01-01')
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class TimeCastTests(unittest.TestCase):
+    def old_cast(self, iso):
+        return DateTime(
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(time.time())[:3] +
+                          time.strptime(iso[:8], "%H:%M:%S")[3:]))
+
+    def test_same_as_strptime(self):
+        for iso in ('00:00:00', '12:34:56', '23:59:59',
+                    '08:30:00.123456', '08:30:00+02', '8:30:00'):
+            self.assertEqual(_cast_Time(iso, None), self.old_cast(iso))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, _cast_Time, '24:00:00', None)
+        self.assertRaises(ValueError, _cast_Time, '12:60:00', None)
+
+    def test_special(self):
+        self.assertEqual(_cast_Time('infinity', None), 'infinity')
+        self.assertEqual(_cast_Time(None, None), None)
+
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,434 @@
+# test the DB object query execution and connection management
+
+from Products.ZPsycopgDA.DA import ZDATETIME
+from Products.ZPsycopgDA.db import DB
+from Products.ZPsycopgDA import pool
+
+import logging
+import psycopg2
+import transaction
+
+import testconfig
+from testutils import unittest
+
+
+class ConnectionSetupTests(unittest.TestCase):
+    def test_setup_once(self):
+        db = DB(testconfig.dsn, tilevel=2, typecasts=[ZDATETIME])
+        db.open()
+        try:
+            conn = db.getconn()
+            self.assertEqual(pool.connstate(db.dsn, conn)['setup'],
+                             (2, 'utf-8', (id(ZDATETIME),)))
+
+            # a connection already set up is not initialized again
+            conn.set_client_encoding('LATIN1')
+            self.assert_(db.getconn() is conn)
+            self.assertEqual(conn.encoding, 'LATIN1')
+            db.putconn()
+        finally:
+            db.close()
+
+
+class DescriptionTests(unittest.TestCase):
+    def test_shared(self):
+        db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        desc = (('id', 23, None, 4, None, None, None),
+                ('name', 25, None, -1, None, None, None))
+        items = db.convert_description(desc)
+        self.assertEqual([(d['name'], d['type']) for d in items],
+                         [('id', 'i'), ('name', 's')])
+        self.assert_(db.convert_description(list(desc)) is items)
+        self.assert_(db.convert_description(desc, True) is not items)
+        self.assertRaises(TypeError, items[0].__setitem__, 'name', 'x')
+
+
+class QueryTimingTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={},
+                     slow_query_time=0.05)
+        self.db.open()
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        logging.getLogger('ZPsycopgDA').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('ZPsycopgDA').removeHandler(self.handler)
+        transaction.abort()
+        self.db.close()
+
+    def test_slow_query_logged(self):
+        self.db.query("select 1\0select pg_sleep(0.1)")
+        self.assertEqual(len(self.records), 1)
+        self.assert_('pg_sleep' in self.records[0].getMessage())
+        self.assert_(self.db.execute_time >= 0.1)
+
+
+class PreparedStatementsTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={},
+                     use_prepared=True)
+        self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_prepared_once(self):
+        for i in range(3):
+            desc, rows = self.db.query(
+                "select %(a)s::int + %(b)s::int, '%%'", {'a': i, 'b': 1})
+            self.assertEqual(rows, [(i + 1, '%')])
+        desc, rows = self.db.query(
+            "select count(*) from pg_prepared_statements")
+        self.assertEqual(rows, [(1,)])
+
+    def prepared_count(self):
+        return self.db.query(
+            "select count(*) from pg_prepared_statements")[1][0][0]
+
+    def test_not_preparable(self):
+        # the type of the parameter can't be inferred
+        for i in range(2):
+            self.assertEqual(self.db.query("select %s", ('a',))[1], [('a',)])
+        self.assertEqual(self.prepared_count(), 0)
+
+    def test_sequence_parameter(self):
+        self.assertEqual(
+            self.db.query("select 1 where 1 in %s", ((1, 2),))[1], [(1,)])
+        self.assertEqual(
+            self.db.query("select coalesce(%s, 0) + 1", (1,))[1], [(2,)])
+
+    def test_lru(self):
+        from Products.ZPsycopgDA import db
+        orig = db.PREPARED_STATEMENTS
+        db.PREPARED_STATEMENTS = 2
+        try:
+            for i in range(4):
+                self.db.query("select %%s::int + %d" % i, (i,))
+            desc, rows = self.db.query(
+                "select count(*) from pg_prepared_statements")
+            self.assertEqual(rows, [(2,)])
+        finally:
+            db.PREPARED_STATEMENTS = orig
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={}, cache_ttl=60)
+        self.db.open()
+        self.db.query("create table test_cache (id int)")
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.query("drop table test_cache")
+        transaction.commit()
+        self.db.getcache().invalidate()
+        self.db.close()
+
+    def test_hit(self):
+        q = "select count(*) from test_cache"
+        self.assertEqual(self.db.query(q)[1], [(0,)])
+        self.assertEqual(self.db.query("select  count(*)\nfrom test_cache")[1],
+                         [(0,)])
+        stats = self.db.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_volatile(self):
+        q = "select nextval('test_cache_seq')"
+        self.db.query("create sequence test_cache_seq")
+        transaction.commit()
+        try:
+            self.assertEqual(self.db.query(q)[1], [(1,)])
+            self.assertEqual(self.db.query(q)[1], [(2,)])
+            self.assertEqual(self.db.cache_stats()['hits'], 0)
+        finally:
+            transaction.abort()
+            self.db.query("drop sequence test_cache_seq")
+            transaction.commit()
+
+    def test_invalidate(self):
+        q = "select count(*) from test_cache"
+        self.assertEqual(self.db.query(q)[1], [(0,)])
+        self.db.query("insert into test_cache values (1)")
+        # the transaction sees its own changes
+        self.assertEqual(self.db.query(q)[1], [(1,)])
+        transaction.commit()
+        self.assertEqual(self.db.query(q)[1], [(1,)])
+        self.assertEqual(self.db.cache_stats()['invalidations'], 1)
+
+    def test_not_modifying(self):
+        self.db.query("select count(*) from test_cache")
+        self.assertEqual(self.db.cache_stats()['entries'], 1)
+        q = "with t as (select id from test_cache) select count(*) from t"
+        self.assertEqual(self.db.query(q)[1], [(0,)])
+        self.db.query("show search_path")
+        transaction.commit()
+        stats = self.db.cache_stats()
+        self.assertEqual((stats['entries'], stats['invalidations']), (1, 0))
+
+
+class MultipleStatementsTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+        self.executed = []
+        self.db._timed = lambda qs, *args: self.executed.append(qs)
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_single_round_trip(self):
+        desc, rows = self.db.query(
+            "create temp table test_multi (id int)\0"
+            "insert into test_multi values (1) -- comment\0"
+            "insert into test_multi values (2)\0"
+            "select count(*) from test_multi")
+        self.assertEqual(rows, [(2,)])
+        self.assertEqual(len(self.executed), 1)
+
+    def test_multiple_selects(self):
+        self.assertRaises(psycopg2.ProgrammingError, self.db.query,
+                          "select 1 as a\0select 'a' as b")
+
+
+class MaxRowsTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_max_rows(self):
+        desc, rows = self.db.query(
+            "select generate_series(1, 1000000) as n", max_rows=3)
+        self.assertEqual([d['name'] for d in desc], ['n'])
+        self.assertEqual(rows, [(1,), (2,), (3,)])
+
+    def test_default_max_rows(self):
+        # the max_rows passed by the Z SQL Methods
+        executed = []
+        self.db._timed = lambda qs, *args: executed.append(qs)
+        self.db.query("create temp table test_max_rows (n int)")
+        desc, rows = self.db.query(
+            "insert into test_max_rows values (1)\0"
+            "insert into test_max_rows select generate_series(2, 2000)\0"
+            "select n from test_max_rows order by n", max_rows=1000)
+        self.assertEqual(rows, [(i,) for i in range(1, 1001)])
+        self.assertEqual(len(executed), 2)
+
+    def test_max_rows_many_statements(self):
+        desc, rows = self.db.query(
+            "select set_config('zpsycopg.x', 'y', true); select 1 as n",
+            max_rows=1000)
+        self.assertEqual(rows, [(1,)])
+        desc, rows = self.db.query("select 1 as n; -- done", max_rows=1000)
+        self.assertEqual(rows, [(1,)])
+        desc, rows = self.db.query("select ';' as n /* ; */", max_rows=1000)
+        self.assertEqual(rows, [(';',)])
+
+    def test_max_rows_prepared(self):
+        self.db.use_prepared = True
+        for i in range(2):
+            desc, rows = self.db.query(
+                "select generate_series(1, %s)", (2000,), max_rows=1000)
+            self.assertEqual(len(rows), 1000)
+        desc, rows = self.db.query(
+            "select count(*) from pg_prepared_statements")
+        self.assertEqual(rows, [(1,)])
+
+    def test_max_rows_update(self):
+        self.db.query("create temp table test_max_rows (n int)")
+        desc, rows = self.db.query(
+            "insert into test_max_rows values (1), (2) returning n",
+            max_rows=1)
+        self.assertEqual(rows, [(1,)])
+
+
+class ExecuteManyTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+        self.db.query("create temp table test_many (id int, data text)")
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_batch(self):
+        self.db.executemany("insert into test_many values (%s, %s)",
+                            [(i, str(i)) for i in range(250)], page_size=100)
+        self.assertEqual(
+            self.db.query("select count(*), sum(data::int) from test_many")[1],
+            [(250, sum(range(250)))])
+
+    def test_values(self):
+        self.db.executemany("insert into test_many (id, data) values %s",
+                            [(i, str(i)) for i in range(250)], page_size=100)
+        self.assertEqual(
+            self.db.query("select count(*), sum(id) from test_many")[1],
+            [(250, sum(range(250)))])
+
+
+class CopyTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+        self.db.query("create temp table test_copy (id int, data text)")
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_float(self):
+        self.db.query("create temp table test_copy_float (x float8)")
+        rows = [(0.1 + 0.2,), (1234567.891234567,)]
+        for format in ('text', 'csv'):
+            self.db.query("delete from test_copy_float")
+            self.db.copy_in('test_copy_float', rows, format=format)
+            self.assertEqual(
+                self.db.query("select x from test_copy_float order by x")[1],
+                rows)
+
+    def test_roundtrip(self):
+        from StringIO import StringIO
+        rows = [(1, 'a\tb\\c\nd'), (2, None), (3, 'x,"y"')]
+        for format in ('text', 'csv'):
+            self.db.query("delete from test_copy")
+            self.db.copy_in('test_copy', rows, ['id', 'data'], format=format)
+            self.assertEqual(
+                self.db.query("select * from test_copy order by id")[1], rows)
+
+        f = StringIO()
+        self.db.copy_out("select * from test_copy order by id", f,
+                         format='csv', header=True, size=10)
+        self.assertEqual(f.getvalue(),
+                         'id,data\n1,"a\tb\\c\nd"\n2,\n3,"x,""y"""\n')
+
+        f = StringIO()
+        self.db.copy_out("with t as (select id from test_copy) "
+                         "select max(id) from t", f)
+        self.assertEqual(f.getvalue(), '3\n')
+
+
+class IterQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def test_chunks(self):
+        desc, chunks = self.db.iterquery(
+            "select generate_series(1, %s) as n", (10,), itersize=3)
+        self.assertEqual([d['name'] for d in desc], ['n'])
+        chunks = list(chunks)
+        self.assertEqual(map(len, chunks), [3, 3, 3, 1])
+        self.assertEqual(sum(chunks, []), [(i,) for i in range(1, 11)])
+
+    def test_empty(self):
+        desc, chunks = self.db.iterquery("select 1 as n where false")
+        self.assertEqual([d['name'] for d in desc], ['n'])
+        self.assertEqual(list(chunks), [])
+
+
+class ReconnectTests(unittest.TestCase):
+    def setUp(self):
+        self.db = DB(testconfig.dsn, tilevel=2, typecasts={})
+        self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def kill(self):
+        pid = self.db.getconn().get_backend_pid()
+        conn = psycopg2.connect(testconfig.dsn)
+        try:
+            conn.cursor().execute("select pg_terminate_backend(%s)", (pid,))
+        finally:
+            conn.close()
+        return pid
+
+    def test_read_retried(self):
+        self.db.query("select 1")
+        pid = self.kill()
+        desc, rows = self.db.query("select pg_backend_pid()")
+        self.assertNotEqual(rows, [(pid,)])
+
+    def test_timeout_not_retried(self):
+        # a new connection wouldn't have the timeout
+        self.db.query("set statement_timeout = 100")
+        self.assertRaises(psycopg2.extensions.QueryCanceledError,
+                          self.db.query, "select pg_sleep(1)")
+
+    def test_write_not_retried(self):
+        self.db.query("create temp table test_reconnect (id int)")
+        self.kill()
+        self.assertRaises(psycopg2.OperationalError, self.db.query,
+                          "select * from test_reconnect")
+
+
+class ReplicaTests(unittest.TestCase):
+    def setUp(self):
+        # the same database, with a different connection string
+        self.replica = testconfig.dsn + ' application_name=zpsycopg_replica'
+        self.db = DB(testconfig.dsn, tilevel=3, typecasts={},
+                     replicas=[self.replica], replica_reads='before_write')
+        self.db.open()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+
+    def app_name(self):
+        return self.db.query("select current_setting('application_name')")[1]
+
+    def test_read_on_replica(self):
+        self.assertEqual(self.app_name(), [('zpsycopg_replica',)])
+        # serializable is not available on a standby
+        self.assertEqual(
+            self.db.query("select current_setting('transaction_isolation')")[1],
+            [('repeatable read',)])
+
+    def test_primary_after_write(self):
+        self.db.query("create temp table test_replica (id int)")
+        self.assertNotEqual(self.app_name(), [('zpsycopg_replica',)])
+        transaction.abort()
+        self.assertEqual(self.app_name(), [('zpsycopg_replica',)])
+
+    def test_transaction_end(self):
+        self.app_name()
+        self.db.query("create temp table test_replica (id int)")
+        self.assertEqual(pool.inuse(self.replica), 1)
+        self.assertEqual(pool.inuse(testconfig.dsn), 1)
+        transaction.abort()
+        self.assertEqual(pool.inuse(self.replica), 0)
+        self.assertEqual(pool.inuse(testconfig.dsn), 0)
+
+    def test_unavailable(self):
+        self.db.replicas = ('dbname=zpsycopg_no_such_db',)
+        self.assertNotEqual(self.app_name(), [('zpsycopg_replica',)])
+
+    def test_readonly_only(self):
+        self.db.replica_reads = 'readonly'
+        self.assertNotEqual(self.app_name(), [('zpsycopg_replica',)])
+        transaction.abort()
+        self.db.set_readonly()
+        self.assertEqual(self.app_name(), [('zpsycopg_replica',)])
+        transaction.abort()
+        self.assertNotEqual(self.app_name(), [('zpsycopg_replica',)])
+
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,294 @@
+# test the connection pool behaviour
+
+from Products.ZPsycopgDA.pool import AbstractConnectionPool
+from Products.ZPsycopgDA.pool import PersistentConnectionPool
+from Products.ZPsycopgDA.pool import parse_host
+from Products.ZPsycopgDA import pool
+from psycopg2.pool import PoolError
+import psycopg2
+import threading
+import time
+
+import testconfig
+from testutils import unittest
+
+
+class PoolTests(unittest.TestCase):
+    def test_wait_for_connection(self):
+        p = PersistentConnectionPool(0, 1, testconfig.dsn, timeout=5)
+        try:
+            conn = p.getconn()
+            got = []
+
+            def waiter():
+                got.append(p.getconn())
+                p.putconn()
+
+            t = threading.Thread(target=waiter)
+            t.start()
+            time.sleep(0.2)
+            self.assertEqual(p.waiting, 1)
+            p.putconn(conn)
+            t.join()
+            self.assertEqual(got, [conn])
+            self.assertEqual(p.waiting, 0)
+        finally:
+            p.closeall()
+
+    def test_wait_timeout(self):
+        p = PersistentConnectionPool(0, 1, testconfig.dsn, timeout=0.2)
+        try:
+            p.getconn()
+            failures = []
+
+            def waiter():
+                try:
+                    p.getconn()
+                except PoolError:
+                    failures.append(True)
+
+            t = threading.Thread(target=waiter)
+            t.start()
+            t.join()
+            self.assertEqual(failures, [True])
+        finally:
+            p.closeall()
+
+    def test_no_timeout(self):
+        p = PersistentConnectionPool(0, 1, testconfig.dsn)
+        try:
+            p.getconn()
+            failures = []
+
+            def waiter():
+                try:
+                    p.getconn()
+                except PoolError:
+                    failures.append(True)
+
+            t = threading.Thread(target=waiter)
+            t.start()
+            t.join()
+            self.assertEqual(failures, [True])
+        finally:
+            p.closeall()
+
+    def test_maxidle(self):
+        p = AbstractConnectionPool(0, 10, testconfig.dsn, maxidle=2)
+        try:
+            conns = [p._getconn() for i in range(3)]
+            for conn in conns:
+                p._putconn(conn)
+            self.assertEqual(p._pool, conns[:2])
+            self.assert_(conns[2].closed)
+        finally:
+            p._closeall()
+
+    def test_stats(self):
+        p = PersistentConnectionPool(1, 5, testconfig.dsn, maxidle=2)
+        try:
+            p.getconn()
+            stats = p.stats()
+            self.assertEqual(stats['created'], 1)
+            self.assertEqual(stats['checkouts'], 1)
+            self.assertEqual(stats['in_use'], 1)
+            self.assertEqual(stats['idle'], 0)
+            self.assertEqual(sum(n for t, n in stats['wait_histogram']), 1)
+            self.assertEqual([k for k, t in stats['holders']],
+                             [threading.current_thread().ident])
+
+            p.putconn()
+            stats = p.stats()
+            self.assertEqual(stats['in_use'], 0)
+            self.assertEqual(stats['idle'], 1)
+            self.assertEqual(stats['holders'], [])
+        finally:
+            p.closeall()
+
+    def test_lazy(self):
+        p = PersistentConnectionPool(2, 5, testconfig.dsn, lazy=True)
+        try:
+            conn = p.getconn()
+            self.assert_(not conn.closed)
+            for i in range(50):
+                if p.stats()['idle'] == 1:
+                    break
+                time.sleep(0.1)
+            stats = p.stats()
+            self.assertEqual(stats['created'], 2)
+            self.assertEqual(stats['in_use'], 1)
+            self.assertEqual(stats['idle'], 1)
+        finally:
+            p.closeall()
+
+
+class MaintainerTests(unittest.TestCase):
+    def setUp(self):
+        self.interval = pool.POOL_MAINTAIN_INTERVAL
+        pool.POOL_MAINTAIN_INTERVAL = 0.1
+
+    def tearDown(self):
+        pool.POOL_MAINTAIN_INTERVAL = self.interval
+
+    def test_min_ready(self):
+        p = PersistentConnectionPool(0, 5, testconfig.dsn, maxidle=5,
+                                     min_ready=2)
+        try:
+            time.sleep(1)
+            self.assertEqual(p.stats()['idle'], 2)
+        finally:
+            p.closeall()
+
+    def test_idle_timeout(self):
+        p = PersistentConnectionPool(3, 5, testconfig.dsn, maxidle=5,
+                                     idle_timeout=0.2, min_ready=1)
+        try:
+            time.sleep(1)
+            stats = p.stats()
+            self.assertEqual(stats['idle'], 1)
+            self.assertEqual(stats['reaped'], 2)
+        finally:
+            p.closeall()
+
+    def test_max_age(self):
+        p = PersistentConnectionPool(1, 5, testconfig.dsn, max_age=0.2)
+        try:
+            conn = p.getconn()
+            time.sleep(0.3)
+            p.putconn(conn)
+            self.assert_(conn.closed)
+            self.assertEqual(p.stats()['expired'], 1)
+        finally:
+            p.closeall()
+
+
+class ValidationTests(unittest.TestCase):
+    def test_status(self):
+        p = PersistentConnectionPool(1, 5, testconfig.dsn, maxidle=5)
+        try:
+            broken = p._pool[0]
+            broken.close()
+            conn = p.getconn()
+            self.assert_(conn is not broken)
+            self.assertEqual(conn.closed, 0)
+            self.assertEqual(p.stats()['invalid'], 1)
+        finally:
+            p.closeall()
+
+    def test_ping(self):
+        p = PersistentConnectionPool(0, 5, testconfig.dsn, maxidle=5,
+                                     validate='ping', ping_after=0)
+        try:
+            conn = p.getconn()
+            p.putconn(conn)
+            # kill the backend: the connection status doesn't notice
+            killer = psycopg2.connect(testconfig.dsn)
+            try:
+                killer.cursor().execute("select pg_terminate_backend(%s)",
+                                        (conn.get_backend_pid(),))
+            finally:
+                killer.close()
+            time.sleep(0.1)
+            self.assert_(p.getconn() is not conn)
+            self.assertEqual(p.stats()['invalid'], 1)
+        finally:
+            p.closeall()
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, PersistentConnectionPool,
+                          0, 1, testconfig.dsn, validate='always')
+
+
+class BreakerTests(unittest.TestCase):
+    def test_trip(self):
+        p = PersistentConnectionPool(0, 5, 'dbname=zpsycopg_no_such_db',
+                                     breaker_threshold=2, breaker_cooldown=0.2)
+        try:
+            for i in range(2):
+                self.assertRaises(psycopg2.OperationalError, p.getconn)
+            self.assertEqual(p.stats()['breaker'], 'open')
+            # fail without connecting
+            self.assertRaises(PoolError, p.getconn)
+            time.sleep(0.3)
+            # the probe is let through, and fails again
+            self.assertRaises(psycopg2.OperationalError, p.getconn)
+            self.assertRaises(PoolError, p.getconn)
+            stats = p.stats()
+            self.assertEqual(stats['connect_errors'], 3)
+            self.assertEqual(stats['trips'], 1)
+            self.assertEqual(stats['rejected'], 2)
+        finally:
+            p.closeall()
+
+    def test_fail_fast_while_probing(self):
+        p = PersistentConnectionPool(0, 5, testconfig.dsn,
+                                     breaker_threshold=1, breaker_cooldown=0)
+        try:
+            def slow_connect():
+                time.sleep(1)
+                raise psycopg2.OperationalError("timeout expired")
+            p._open_host = slow_connect
+            p._tripped = time.time()
+            errors = []
+
+            def probe():
+                try:
+                    p.getconn()
+                except psycopg2.Error, e:
+                    errors.append(e)
+
+            t = threading.Thread(target=probe)
+            t.start()
+            time.sleep(0.2)
+            start = time.time()
+            self.assertEqual(p.stats()['breaker'], 'half-open')
+            self.assertRaises(PoolError, p.getconn)
+            self.assert_(time.time() - start < 0.5)
+            t.join()
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(p.stats()['connecting'], 0)
+        finally:
+            p.closeall()
+
+    def test_close(self):
+        p = PersistentConnectionPool(0, 5, testconfig.dsn,
+                                     breaker_threshold=1, breaker_cooldown=0)
+        try:
+            p._tripped = time.time()
+            p.getconn()
+            stats = p.stats()
+            self.assertEqual(stats['breaker'], 'closed')
+            self.assertEqual(stats['failures'], 0)
+        finally:
+            p.closeall()
+
+
+class HostsTests(unittest.TestCase):
+    def test_parse_host(self):
+        self.assertEqual(parse_host('db1'), ('db1', None))
+        self.assertEqual(parse_host(' db1:5433 '), ('db1', 5433))
+        self.assertEqual(parse_host('[::1]:5433'), ('::1', 5433))
+        self.assertEqual(parse_host('::1'), ('::1', None))
+
+    def test_failover(self):
+        # nobody listens on port 1
+        p = PersistentConnectionPool(0, 5, testconfig.dsn,
+                                     hosts=[('127.0.0.1', 1),
+                                            ('localhost', None)])
+        try:
+            conn = p.getconn()
+            self.assertEqual(p.connstate(conn)['host'], ('localhost', None))
+            hosts = p.stats()['hosts']
+            self.assertEqual([h['up'] for h in hosts], [False, True])
+            self.assert_(hosts[0]['failures'] >= 1)
+            # the host down is tried last
+            self.assertEqual(p._monitor.order()[0], ('localhost', None))
+        finally:
+            p.closeall()
+
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
+
+if __name__ == "__main__":
+    unittest.main()